@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
+from pychopper.common_structures import Hit
+
 
 def process_hits(hits, max_score):
     "Process alignment hits by removing overlaps"
@@ -18,3 +21,131 @@ def process_hits(hits, max_score):
             else:
                 res.append(hit)
     return tuple(res)
+
+
+class HitBatch:
+    """Columnar alignment hits of a batch of reads.
+
+    Coordinates are int32 arrays and primer names are interned to small integers, indexing the
+    queries tuple. The hits of read i are the rows offsets[i]:offsets[i + 1]. Scores are kept
+    as float64, so cutoffs select exactly the same hits as on Hit tuples.
+    """
+
+    def __init__(self, queries, query_ids, ref_start, ref_end, query_start, query_end, score, offsets):
+        self.queries = queries
+        self.query_ids = query_ids
+        self.ref_start = ref_start
+        self.ref_end = ref_end
+        self.query_start = query_start
+        self.query_end = query_end
+        self.score = score
+        self.offsets = offsets
+
+    @classmethod
+    def from_hits(cls, batch_hits):
+        "Build a batch from the lists of Hit tuples of the reads"
+        flat = [hit for hits in batch_hits for hit in hits]
+        queries = {}
+        query_ids = np.array([queries.setdefault(hit.Query, len(queries)) for hit in flat], dtype=np.int16)
+        nr_hits = [len(hits) for hits in batch_hits]
+        return cls(
+            tuple(queries),
+            query_ids,
+            np.array([hit.RefStart for hit in flat], dtype=np.int32),
+            np.array([hit.RefEnd for hit in flat], dtype=np.int32),
+            np.array([hit.QueryStart for hit in flat], dtype=np.int32),
+            np.array([hit.QueryEnd for hit in flat], dtype=np.int32),
+            np.array([hit.Score for hit in flat], dtype=np.float64),
+            np.concatenate(([0], np.cumsum(nr_hits, dtype=np.int64))),
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def read_ids(self):
+        "Index of the read of each hit"
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def read_hits(self, i):
+        "View of the hits of read i"
+        return ReadHits(self, int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def take(self, rows, offsets):
+        "Build a batch from the given rows, offsets delimiting the rows of each read"
+        return HitBatch(self.queries, self.query_ids[rows], self.ref_start[rows], self.ref_end[rows],
+                        self.query_start[rows], self.query_end[rows], self.score[rows], offsets)
+
+    def select(self, mask):
+        "Keep the hits selected by a boolean mask"
+        counts = np.bincount(self.read_ids()[mask], minlength=len(self))
+        return self.take(np.flatnonzero(mask), np.concatenate(([0], np.cumsum(counts))))
+
+    def config_table(self, config):
+        """Translate a primer configuration to integer pairs. Return the strands and a table giving
+        the index of the strand of each (query id, query id) pair, 0 (strand None) if not in config.
+        """
+        ids = {q: i for i, q in enumerate(self.queries)}
+        strands = [None]
+        table = np.zeros((len(ids), len(ids)), dtype=np.int8)
+        for (q0, q1), strand in config.items():
+            if q0 in ids and q1 in ids:
+                table[ids[q0], ids[q1]] = len(strands)
+                strands.append(strand)
+        return strands, table
+
+
+class ReadHits:
+    "View of the hits of a single read in a HitBatch, iterating gives Hit tuples without reference name"
+    __slots__ = ("batch", "start", "end")
+
+    def __init__(self, batch, start, end):
+        self.batch = batch
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        b = self.batch
+        for k in range(self.start, self.end):
+            yield Hit(None, int(b.ref_start[k]), int(b.ref_end[k]), b.queries[b.query_ids[k]],
+                      int(b.query_start[k]), int(b.query_end[k]), float(b.score[k]))
+
+    @property
+    def queries(self):
+        "Names of the primers hit"
+        b = self.batch
+        return [b.queries[q] for q in b.query_ids[self.start:self.end].tolist()]
+
+
+def process_hits_batch(batch, max_score):
+    """Process the alignment hits of a batch of reads by removing overlaps, like process_hits on each read.
+    Returns a new HitBatch.
+    """
+    n = len(batch)
+    read_ids = batch.read_ids()
+    rows = np.flatnonzero(~(batch.score > max_score))
+    # Sort by read, then by start and end, keeping the input order of ties like sorted():
+    rows = rows[np.lexsort((batch.ref_end[rows], batch.ref_start[rows], read_ids[rows]))]
+    counts = np.bincount(read_ids[rows], minlength=n)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    kept = np.zeros(len(rows), dtype=bool)
+    # Process reads by decreasing number of hits, so the reads still active are a prefix:
+    order = np.argsort(-counts, kind="stable")
+    counts_sorted = counts[order]
+    firsts = offsets[:-1][order]
+    # Position of the last kept hit of each read, which a better overlapping hit replaces:
+    top = np.full(n, -1, dtype=np.int64)
+    for j in range(counts_sorted[0] if n > 0 else 0):
+        active = np.searchsorted(-counts_sorted, -j)
+        idx = firsts[:active] + j
+        last = top[:active]
+        last_rows, hit_rows = rows[last], rows[idx]
+        replace = (last >= 0) & (batch.ref_end[last_rows] > batch.ref_start[hit_rows]) & \
+            (batch.score[hit_rows] < batch.score[last_rows])
+        kept[last[replace]] = False
+        kept[idx] = True
+        top[:active] = idx
+    counts = np.bincount(read_ids[rows[kept]], minlength=n)
+    return batch.take(rows[kept], np.concatenate(([0], np.cumsum(counts))))
@@ -4,8 +4,13 @@ import sys
 import numpy as np
 from pychopper import seq_utils as seu
 from pychopper import hmmer_backend, edlib_backend
+from pychopper import utils
 from pychopper.common_structures import Segment, Seq
-from pychopper.alignment_hits import process_hits
+from pychopper.alignment_hits import process_hits_batch, HitBatch, ReadHits
+from pychopper.umi import UmiMatcher
+
+# UMI probes are compiled once per process:
+_UMI_MATCHER = UmiMatcher()
 
 
 def _build_segments(hits, config):
@@ -75,9 +80,89 @@ def analyse_hits(hits, config):
     return tuple(valid_segments), hits, tlen
 
 
-def segments_to_reads(read, segments, keep_primers, bam_tags, detect_umis):
-    "Convert segments to output reads with annotation"
-    for s in segments:
+def _segment_dp(seg_lens, seg_offsets):
+    """Run the include/exclude segmentation DP of analyse_hits over many reads at once.
+    seg_lens holds the lengths of the segments of all reads, the segments of read i being
+    seg_lens[seg_offsets[i]:seg_offsets[i + 1]]. Returns the mask of segments in the solution
+    (in the traceback of analyse_hits) and the index of the best final state of each read.
+    """
+    nr_segs = np.diff(seg_offsets)
+    include = np.zeros(len(seg_lens), dtype=bool)
+    # The excluded state of a segment is reached from the included state of the previous one:
+    from_included = np.zeros(len(seg_lens), dtype=bool)
+    tlen = np.zeros(len(nr_segs), dtype=np.int64)
+    # Process reads by decreasing number of segments, so the reads still active are a prefix:
+    order = np.argsort(-nr_segs, kind="stable")
+    order = order[nr_segs[order] > 0]
+    if len(order) == 0:
+        return include, tlen
+    firsts = seg_offsets[:-1][order]
+    counts = nr_segs[order]
+    excluded = np.zeros(len(order), dtype=np.int64)
+    included = seg_lens[firsts].astype(np.int64)
+    for j in range(1, counts[0]):
+        # Number of reads having more than j segments:
+        active = np.searchsorted(-counts, -j)
+        idx = firsts[:active] + j
+        prev_exc, prev_inc = excluded[:active], included[:active]
+        better = prev_inc > prev_exc
+        from_included[idx] = better
+        new_exc = np.where(better, prev_inc, prev_exc)
+        included[:active] = prev_exc + seg_lens[idx]
+        excluded[:active] = new_exc
+    # Ties are resolved in favour of the excluded state, like np.argmax:
+    state = (included > excluded).astype(np.int64)
+    tlen[order] = state
+    for j in range(counts[0] - 1, -1, -1):
+        # Reads whose last segment is j start their traceback here:
+        active = np.searchsorted(-counts, -j)
+        idx = firsts[:active] + j
+        st = state[:active]
+        include[idx] = st == 1
+        state[:active] = np.where(st == 1, 0, from_included[idx])
+    return include, tlen
+
+
+def analyse_hits_batch(batch, config):
+    """Segment the reads of a HitBatch at once, giving the same results as analyse_hits on the hits
+    of each read. The DP runs vectorized across reads, hits are returned as ReadHits views.
+    """
+    strands, strand_table = batch.config_table(config)
+    nr_hits = np.diff(batch.offsets)
+    # Segments are the pairs of consecutive hits of the same read:
+    nr_segs = np.maximum(nr_hits - 1, 0)
+    seg_offsets = np.concatenate(([0], np.cumsum(nr_segs)))
+    seg_hits = np.flatnonzero(np.repeat(nr_hits > 1, nr_hits))
+    seg_hits = seg_hits[np.isin(seg_hits + 1, batch.offsets[1:], invert=True)]
+    seg_strands = strand_table[batch.query_ids[seg_hits], batch.query_ids[seg_hits + 1]]
+    seg_lens = np.where(seg_strands > 0,
+                        batch.ref_start[seg_hits + 1].astype(np.int64) - batch.ref_end[seg_hits], 0)
+
+    include, tlen = _segment_dp(seg_lens, seg_offsets)
+    include &= seg_lens > 0
+    res = []
+    seg_offsets, tlen = seg_offsets.tolist(), tlen.tolist()
+    for i in range(len(batch)):
+        first, last = seg_offsets[i], seg_offsets[i + 1]
+        if first == last:
+            res.append(((), ReadHits(batch, 0, 0), 0))
+            continue
+        segments = []
+        # Segments are listed in traceback order, like in analyse_hits:
+        for k in (first + np.flatnonzero(include[first:last])[::-1]).tolist():
+            h0, h1 = seg_hits[k], seg_hits[k] + 1
+            left, start = int(batch.ref_start[h0]), int(batch.ref_end[h0])
+            end, right = int(batch.ref_start[h1]), int(batch.ref_end[h1])
+            segments.append(Segment(left, start, end, right, strands[seg_strands[k]], end - start))
+        res.append((tuple(segments), batch.read_hits(i), tlen[i]))
+    return res
+
+
+def segments_to_reads(read, segments, keep_primers, bam_tags, umis=None):
+    """Convert segments to output reads with annotation.
+    umis is the list of (UMI, edit distance) pairs of the segments, or None if UMIs are not detected.
+    """
+    for i, s in enumerate(segments):
         Start = s.Start
         End = s.End
         if keep_primers:
@@ -100,30 +185,8 @@ def segments_to_reads(read, segments, keep_primers, bam_tags, detect_umis):
             sr_name += " rescue=1"
 
         umi = None
-        if detect_umis:
-            max_umi_ed = 3
-            # Detect UMIs
-            # Get adapters for UMI search
-            padding = 40
-            p1_from = max(0, s.Left - padding)
-            p1_to = min(len(read.Seq), s.Start + padding)
-            p_1 = read.Seq[p1_from:p1_to]
-            p2_from = max(0, s.End - padding)
-            p2_to = min(len(read.Seq), s.Right + padding)
-            p_2 = read.Seq[p2_from:p2_to]
-
-            # Create a single probe containing adapter-surrounding sequences.
-            # to be used in a single UMI search. Separate with 'N' spacer to prevent
-            # overlapping hits
-            umi_scan_seq = p_1 + 'NNNNNNNNNNNNNNNNNNNNNNNNNNNNNNN' + p_2
-
-            # If the read is small and the adapter regions + padding overlap,
-            # then use only the whole read for the UMI search
-            if p1_to >= p2_from:
-                umi_scan_seq = read.Seq
-
-            umi, _ = edlib_backend.find_umi_single(
-                [umi_scan_seq, max_umi_ed])
+        if umis is not None:
+            umi, _ = umis[i]
             if bam_tags:
                 sr_name += "\tRX:Z:{}".format(umi)
             else:
@@ -136,17 +199,113 @@ def segments_to_reads(read, segments, keep_primers, bam_tags, detect_umis):
         yield sr
 
 
-def chopper_phmm(reads, phmm_file, config, cutoff, threads, pool, min_batch):
-    "Segment using the profile HMM backend"
-    batch_hits = hmmer_backend.find_locations(reads, phmm_file, E=cutoff, pool=pool, min_batch=min_batch)
-    for i, hits in enumerate(batch_hits):
-        hits = process_hits(hits, cutoff)
-        yield reads[i], analyse_hits(hits, config)
+def _segment_batch(params):
+    """Find hits, segments and optionally UMIs of a batch of reads in a worker process.
+    Hits are found by the locate function of the backend the worker was initialized for.
+    Returns the processed HitBatch and the segments, usable length and UMIs of each read.
+    """
+    locate, reads, config, cutoff, detect_umis = params
+    batch = process_hits_batch(HitBatch.from_hits(locate(reads)), cutoff)
+    res = analyse_hits_batch(batch, config)
+    if not detect_umis:
+        return batch, [(segments, usable_len, None) for segments, _, usable_len in res]
+    # UMIs of all segments of the batch are searched at once:
+    umis = iter(_UMI_MATCHER.find_umis([(read, s) for read, (segments, _, _) in zip(reads, res) for s in segments]))
+    return batch, [(segments, usable_len, [next(umis) for _ in segments]) for segments, _, usable_len in res]
+
+
+def _batch_results(reads, batch, res):
+    "Pair the reads of a batch with the results of _segment_batch, yields reads with their segmentation and UMIs"
+    for i, (read, (segments, usable_len, umis)) in enumerate(zip(reads, res)):
+        # Hits of reads with a single hit are dropped, like in analyse_hits:
+        hits = batch.read_hits(i)
+        if len(hits) < 2:
+            hits = ReadHits(batch, 0, 0)
+        yield read, (segments, hits, usable_len), umis
+
+
+def chopper_batch(locate, reads, config, cutoff, detect_umis=False):
+    """Segment a batch of reads in the current process, where locate is the find_batch_locations
+    function of an initialized backend. Yields reads, their segmentation and UMIs like chopper_edlib.
+    """
+    batch, res = _segment_batch((locate, reads, config, cutoff, detect_umis))
+    return _batch_results(reads, batch, res)
+
+
+def _chopper(locate, reads, config, cutoff, pool, min_batch, detect_umis, max_bases):
+    """Segment reads in batches processed by the worker pool, the batches with the most bases first.
+    Yields reads with their segmentation and UMIs.
+    """
+    batches = list(utils.batch(reads, max(min_batch, 1), max_bases))
+    params = [(locate, b, config, cutoff, detect_umis) for b in batches]
+    weights = [utils.batch_bases(b) for b in batches]
+    for reads_batch, (batch, res) in zip(batches, utils.balanced_map(pool, _segment_batch, params, weights)):
+        yield from _batch_results(reads_batch, batch, res)
+
+
+def chopper_phmm(reads, config, cutoff, pool, min_batch, detect_umis=False, max_bases=utils.MAX_BATCH_BASES):
+    """Segment using the profile HMM backend, pool workers must be initialized by hmmer_backend.init_worker.
+    Yields reads, their segmentation and the UMIs of the segments (None if detect_umis is False).
+    """
+    return _chopper(hmmer_backend.find_batch_locations, reads, config, cutoff, pool, min_batch, detect_umis, max_bases)
+
+
+def _tune_batch(batch_hits):
+    "Build a HitBatch and the array of hit kinds from the results of hmmer_backend.find_tune_locations"
+    batch_hits = list(batch_hits)
+    batch = HitBatch.from_hits([hits for hits, _ in batch_hits])
+    kinds = np.array([k for _, hit_kinds in batch_hits for k in hit_kinds], dtype=np.int8)
+    return batch, kinds
+
 
+def _segment_tune_batch(batch, kinds, cutoff, config):
+    "Segment the reads of a HitBatch of tuning hits at a cutoff, returns the list of results"
+    # In end window mode, whether a read is searched as a whole depends on the cutoff:
+    selected = utils.select_end_hits(batch.read_ids(), kinds, ~(batch.score > cutoff), len(batch))
+    return analyse_hits_batch(process_hits_batch(batch.select(selected), cutoff), config)
 
-def chopper_edlib(reads, primers, config, max_ed, cutoff, pool, min_batch):
-    "Segment using the edlib/parasail backend"
-    batch_hits = edlib_backend.find_locations(reads, primers, max_ed=max_ed, pool=pool, min_batch=min_batch)
-    for i, hits in enumerate(batch_hits):
-        hits = process_hits(hits, cutoff)
-        yield reads[i], analyse_hits(hits, config)
+
+def chopper_phmm_tune(reads, config, cutoffs, pool, min_batch, max_bases=utils.MAX_BATCH_BASES):
+    """Segment using the profile HMM backend for a series of E-value cutoffs, using a single nhmmscan pass.
+    The pool workers must be initialized by hmmer_backend.init_worker with the largest cutoff,
+    tighter cutoffs are evaluated by filtering the cached hits. The E-values printed by nhmmscan
+    are rounded, so the reads with hits too close to a cutoff are searched again at that cutoff.
+    Yields the cutoff and the list of results for each cutoff.
+    """
+    batch, kinds = _tune_batch(hmmer_backend.find_tune_locations(reads, pool=pool, min_batch=min_batch, max_bases=max_bases))
+    read_ids = batch.read_ids()
+    for cutoff in cutoffs:
+        res = _segment_tune_batch(batch, kinds, cutoff, config)
+        # The hits at the largest cutoff are exactly the ones of the workers:
+        near = np.unique(read_ids[hmmer_backend.near_cutoff(batch.score, cutoff)]).tolist() if cutoff < max(cutoffs) else []
+        if len(near) > 0:
+            near_batch, near_kinds = _tune_batch(hmmer_backend.find_tune_locations(
+                [reads[i] for i in near], pool=pool, min_batch=min_batch, max_bases=max_bases, E=cutoff))
+            for i, near_res in zip(near, _segment_tune_batch(near_batch, near_kinds, cutoff, config)):
+                res[i] = near_res
+        yield cutoff, list(zip(reads, res))
+
+
+def chopper_edlib(reads, config, cutoff, pool, min_batch, detect_umis=False, max_bases=utils.MAX_BATCH_BASES):
+    """Segment using the edlib/parasail backend, pool workers must be initialized by edlib_backend.init_worker.
+    Yields reads, their segmentation and the UMIs of the segments (None if detect_umis is False).
+    """
+    return _chopper(edlib_backend.find_batch_locations, reads, config, cutoff, pool, min_batch, detect_umis, max_bases)
+
+
+def chopper_edlib_tune(reads, primers, config, cutoffs, max_eds, pool, min_batch, max_bases=utils.MAX_BATCH_BASES):
+    """Segment using the edlib/parasail backend for a series of cutoffs, using a single alignment pass.
+    The pool workers must be initialized by edlib_backend.init_worker with the largest of max_eds.
+    Yields the cutoff and the list of results for each cutoff.
+    """
+    batch_hits = list(edlib_backend.find_scored_locations(reads, pool=pool, min_batch=min_batch, max_bases=max_bases))
+    batch = HitBatch.from_hits([[hit for hit, _, _ in scored_hits] for scored_hits in batch_hits])
+    eds = np.array([ed for scored_hits in batch_hits for _, ed, _ in scored_hits], dtype=np.int64)
+    kinds = np.array([kind for scored_hits in batch_hits for _, _, kind in scored_hits], dtype=np.int8)
+    read_ids = batch.read_ids()
+    for cutoff, max_ed in zip(cutoffs, max_eds):
+        budgets = np.array([edlib_backend.primer_budget(primers[q], max_ed) for q in batch.queries], dtype=np.int64)
+        # In end window mode, whether a read is aligned as a whole depends on the cutoff:
+        selected = utils.select_end_hits(read_ids, kinds, eds <= budgets[batch.query_ids], len(batch))
+        res = analyse_hits_batch(process_hits_batch(batch.select(selected), cutoff), config)
+        yield cutoff, list(zip(reads, res))
@@ -1,21 +1,57 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import edlib
 
 from pychopper import seq_utils as seu
 from pychopper.common_structures import Hit
 from pychopper import utils
-from pychopper.parasail_backend import refine_locations
+from pychopper.parasail_backend import refine_locations, create_profiles
+from pychopper.primer_index import PrimerIndex
 
+# Per-process search state, installed once in each worker by init_worker:
+_WORKER = {}
 
-def find_locations(reads, all_primers, max_ed, pool, min_batch):
-    "Find alignment hits of all primers in all reads using the edlib/parasail backend"
-    for batch in utils.batch(reads, min_batch):
-        for res in pool.map(_find_locations_single, zip(batch, [(all_primers, max_ed)] * len(batch))):
-            try:
-                yield res
-            except StopIteration:
-                return
+
+def primer_budget(primer_seq, max_ed):
+    "Maximum edit distance allowed for a primer given the relative cutoff max_ed"
+    return int(max_ed * len(primer_seq))
+
+
+def init_worker(all_primers, max_ed, end_window=None, seed_k=None):
+    """Install primers, per-primer edit distance budgets and alignment profiles in a worker process.
+    If end_window is not None, only that many bases are searched at each end of the reads.
+    If seed_k is not None, primers are only aligned to the read windows having at least two
+    exact k-mer matches with them.
+    """
+    _WORKER["primers"] = all_primers
+    _WORKER["budgets"] = {acc: primer_budget(seq, max_ed) for acc, seq in all_primers.items()}
+    _WORKER["profiles"] = create_profiles(all_primers)
+    _WORKER["end_window"] = end_window
+    _WORKER["index"] = PrimerIndex(all_primers, seed_k) if seed_k is not None else None
+
+
+def find_locations(reads, pool, min_batch, max_bases=utils.MAX_BATCH_BASES):
+    """Find alignment hits of all primers in all reads using the edlib/parasail backend.
+    The pool must have been created with init_worker as initializer. Reads are dispatched in
+    batches of at most min_batch reads and max_bases bases, the largest batches first.
+    """
+    batches = list(utils.batch(reads, max(min_batch, 1), max_bases))
+    for res in utils.balanced_map(pool, find_batch_locations, batches, [utils.batch_bases(b) for b in batches]):
+        yield from res
+
+
+def find_scored_locations(reads, pool, min_batch, max_bases=utils.MAX_BATCH_BASES):
+    """Find alignment hits like find_locations, but return (hit, edit distance, kind) triples.
+    Hits found at a given max_ed are exactly the pairs with edit distance within
+    primer_budget(primer, max_ed), hence results for any tighter cutoff can be
+    derived without aligning again. In end window mode the reads longer than two windows
+    are aligned both in their ends and as a whole, the kinds are those of
+    utils.search_read_ends_all.
+    """
+    batches = list(utils.batch(reads, max(min_batch, 1), max_bases))
+    for res in utils.balanced_map(pool, _find_scored_batch_locations, batches, [utils.batch_bases(b) for b in batches]):
+        yield from res
 
 
 def find_umi_single(params):
@@ -72,24 +108,156 @@ def find_umi_single(params):
     return umi, ed
 
 
-def _find_locations_single(params):
+def find_batch_locations(reads):
+    "Find alignment hits of all primers in a batch of reads using the edlib/parasail backend, in a worker process"
+    return [_find_locations_single(read) for read in reads]
+
+
+def find_window_locations(window, offset, read_len):
+    """Find alignment hits of all primers in a window of a long read starting at offset, in a worker process.
+    Return the hits in read coordinates paired with the edit distances of the edlib hits.
+    """
+    hits, eds = _align_primers_whole(window)
+    return [(utils.shift_hit(hit, offset), ed) for hit, ed in zip(hits, eds)]
+
+
+def merge_window_hits(window_results):
+    """Merge the results of find_window_locations on the windows of a read. Like an alignment of
+    the whole read, only the hits at the smallest edit distance of each primer are kept.
+    """
+    scored_hits = [x for res in window_results for x in res]
+    best = {}
+    for hit, ed in scored_hits:
+        best[hit.Query] = min(ed, best.get(hit.Query, ed))
+    return utils.dedup_hits([hit for hit, ed in scored_hits if ed == best[hit.Query]])
+
+
+def _find_scored_batch_locations(reads):
+    "Find scored alignment hits of all primers in a batch of reads, in a worker process"
+    return [_find_scored_locations_single(read) for read in reads]
+
+
+def _find_locations_single(read):
     "Find alignment hits of all primers in a single reads using the edlib/parasail backend"
-    read = params[0]
-    all_primers, max_ed = params[1]
+    return _align_primers(read)[0]
+
+
+def _find_scored_locations_single(read):
+    "Find alignment hits of all primers in a single read, with their edit distances and kinds"
+    return list(zip(*_align_primers_all(read)))
+
+
+def _align_primers(read):
+    """Align all primers to a read, return refined hits and the edit distances of the edlib hits.
+    In end window mode the whole read is aligned only if fewer than two hits are found in the ends.
+    """
+    end_window = _WORKER["end_window"]
+    if end_window is not None and len(read.Seq) > 2 * end_window:
+        hits, eds = [], []
+        for offset, window in utils.end_windows(read, end_window):
+            window_hits, window_eds = _align_primers_whole(window)
+            hits.extend(utils.shift_hit(h, offset) for h in window_hits)
+            eds.extend(window_eds)
+        if len(hits) >= 2:
+            return hits, eds
+    return _align_primers_whole(read)
+
+
+def _align_primers_all(read):
+    """Align all primers to a read for cutoff tuning. Reads longer than two end windows are aligned
+    both in their ends and as a whole, so the fallback can be decided at each cutoff.
+    Return refined hits, the edit distances of the edlib hits and the kinds of the hits.
+    """
+    end_window = _WORKER["end_window"]
+    hits, eds = _align_primers_whole(read)
+    if end_window is None or len(read.Seq) <= 2 * end_window:
+        return hits, eds, [utils.ONLY_HIT] * len(hits)
+    end_hits, end_eds = [], []
+    for offset, window in utils.end_windows(read, end_window):
+        window_hits, window_eds = _align_primers_whole(window)
+        end_hits.extend(utils.shift_hit(h, offset) for h in window_hits)
+        end_eds.extend(window_eds)
+    return end_hits + hits, end_eds + eds, [utils.END_HIT] * len(end_hits) + [utils.WHOLE_HIT] * len(hits)
+
+
+def _align_primers_whole(read):
+    "Align all primers to the whole read, return refined hits and the edit distances of the edlib hits"
+    all_primers = _WORKER["primers"]
+    budgets = _WORKER["budgets"]
+    index = _WORKER["index"]
+    seeds = index.read_seeds(read.Seq) if index is not None else None
     all_locations = []
+    eds = []
     for primer_acc, primer_seq in all_primers.items():
-        primer_max_ed = int(max_ed * len(primer_seq))
-        result = edlib.align(primer_seq, read.Seq,
-                             mode="HW", task="locations", k=primer_max_ed)
-        ed = result["editDistance"]
-        locations = result["locations"]
+        if index is None:
+            ed, locations = _align_primer(primer_seq, read.Seq, budgets[primer_acc])
+        else:
+            windows = index.windows(seeds, primer_acc, budgets[primer_acc])
+            ed, locations = _align_primer_windows(primer_seq, read.Seq, budgets[primer_acc], windows)
         if locations:
-            # all_locations[primer_acc] = []
-            for refstart, refend in locations:
-                refend += 1
-                # ('Hit', 'Ref RefStart RefEnd Query QueryStart QueryEnd Score')
-                hit = Hit(read.Name, refstart, refend, primer_acc, 0,
-                          len(primer_seq),  ed / len(primer_seq))
-                all_locations.append(hit)
-    refined_locations = refine_locations(read, all_primers, all_locations)
-    return refined_locations
+            all_locations.extend(_refine_primer_locations(read, primer_acc, primer_seq, ed, locations))
+            eds.extend([ed] * len(locations))
+    return all_locations, eds
+
+
+def _refine_primer_locations(read, primer_acc, primer_seq, ed, locations):
+    """Refine the edlib locations of a primer, giving the same hits as refine_locations on each location.
+    Overlapping locations are refined once over their union. A location containing the alignment
+    of its union has the same best local alignment, the other locations are refined on their own.
+    """
+    primers = {primer_acc: primer_seq}
+    profiles = _WORKER["profiles"]
+
+    def hits(spans):
+        # ('Hit', 'Ref RefStart RefEnd Query QueryStart QueryEnd Score')
+        return [Hit(read.Name, start, end, primer_acc, 0, len(primer_seq), ed / len(primer_seq)) for start, end in spans]
+
+    windows = merge_locations(locations)
+    refined = refine_locations(read, primers, hits(windows), profiles=profiles)
+    window_starts = [start for start, _ in windows]
+    res = []
+    alone = []
+    for start, end in locations:
+        rloc = refined[bisect.bisect_right(window_starts, start) - 1]
+        if start <= rloc.RefStart and rloc.RefEnd <= end + 1:
+            res.append(rloc)
+        else:
+            alone.append(len(res))
+            res.append((start, end + 1))
+    for i, rloc in zip(alone, refine_locations(read, primers, hits([res[i] for i in alone]), profiles=profiles)):
+        res[i] = rloc
+    return res
+
+
+def merge_locations(locations):
+    """Merge overlapping edlib locations (inclusive end) into clusters.
+    Return the sorted (start, end) windows spanned by the clusters, with exclusive ends.
+    """
+    res = []
+    for start, end in sorted(locations):
+        if len(res) > 0 and start < res[-1][1]:
+            res[-1][1] = max(res[-1][1], end + 1)
+        else:
+            res.append([start, end + 1])
+    return [tuple(w) for w in res]
+
+
+def _align_primer(primer_seq, seq, k):
+    "Align a primer to a sequence using edlib, return the edit distance and the locations of the best hits"
+    result = edlib.align(primer_seq, seq, mode="HW", task="locations", k=k)
+    return result["editDistance"], result["locations"]
+
+
+def _align_primer_windows(primer_seq, seq, k, windows):
+    """Align a primer to windows of a sequence, return the best edit distance across windows and
+    the locations of the hits at that distance.
+    """
+    best_ed, best_locations = -1, []
+    for start, end in windows:
+        ed, locations = _align_primer(primer_seq, seq[start:end], k)
+        if ed == -1 or (best_ed != -1 and ed > best_ed):
+            continue
+        if ed != best_ed:
+            best_ed, best_locations = ed, []
+        best_locations.extend((start + s, start + e) for s, e in locations)
+    return best_ed, best_locations
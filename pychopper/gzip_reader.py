@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the reads from compressed files:
+READ_SIZE = 1 << 22
+# Number of BGZF blocks decompressed by each task:
+BGZF_TASK_BLOCKS = 64
+
+# Pipes fed by DecompressedInput threads. Forked processes, like pool workers, close them,
+# otherwise the readers would never see the end of the data:
+_FEEDER_FDS = set()
+
+
+def _close_feeder_fds():
+    for fd in _FEEDER_FDS:
+        os.close(fd)
+    _FEEDER_FDS.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_close_feeder_fds)
+
+
+def is_gzip(path):
+    "Check whether a file is gzip compressed (this includes BGZF)"
+    with open(path, "rb") as fh:
+        return fh.read(2) == b"\x1f\x8b"
+
+
+def is_bgzf(path):
+    "Check whether a file is BGZF compressed: its first gzip member has a BC extra subfield"
+    with open(path, "rb") as fh:
+        header = fh.read(16)
+    return len(header) == 16 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def _bgzf_blocks(fh):
+    "Yield the raw deflate data of the BGZF blocks of a file, with their uncompressed sizes"
+    while True:
+        header = fh.read(12)
+        if len(header) == 0:
+            return
+        if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+            raise Exception("Invalid BGZF block header!")
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = fh.read(xlen)
+        bsize = None
+        pos = 0
+        while pos + 4 <= xlen:
+            si, slen = extra[pos:pos + 2], struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+            if si == b"BC":
+                bsize = struct.unpack("<H", extra[pos + 4:pos + 6])[0]
+            pos += 4 + slen
+        if bsize is None:
+            raise Exception("BGZF block without size!")
+        data = fh.read(bsize - xlen - 11)
+        yield data[:-8], struct.unpack("<I", data[-4:])[0]
+
+
+def _inflate_blocks(blocks):
+    "Decompress a list of BGZF blocks, return the concatenated data"
+    res = []
+    for cdata, size in blocks:
+        data = zlib.decompress(cdata, -15)
+        if len(data) != size:
+            raise Exception("Corrupt BGZF block!")
+        res.append(data)
+    return b"".join(res)
+
+
+def _bgzf_chunks(path, threads):
+    "Decompress a BGZF file, decompressing groups of blocks in parallel. Yields data chunks in order"
+    pending = deque()
+    with open(path, "rb") as fh, ThreadPoolExecutor(max_workers=threads) as pool:
+        blocks = _bgzf_blocks(fh)
+        while True:
+            task = [b for _, b in zip(range(BGZF_TASK_BLOCKS), blocks)]
+            if len(task) > 0:
+                pending.append(pool.submit(_inflate_blocks, task))
+            if len(pending) > 0 and (len(task) == 0 or len(pending) >= 2 * threads):
+                yield pending.popleft().result()
+            elif len(task) == 0:
+                return
+
+
+def _gzip_chunks(path):
+    "Decompress a gzip file, which can have several members. Yields data chunks"
+    with open(path, "rb") as fh:
+        decomp = zlib.decompressobj(31)
+        while True:
+            data = fh.read(READ_SIZE)
+            if len(data) == 0:
+                break
+            while len(data) > 0:
+                yield decomp.decompress(data)
+                data = b""
+                if decomp.eof:
+                    # Start of the next member:
+                    data = decomp.unused_data
+                    decomp = zlib.decompressobj(31)
+        yield decomp.flush()
+
+
+def decompressed_chunks(path, threads=4):
+    """Decompress a gzip or BGZF file, yielding the data in chunks. BGZF blocks are decompressed
+    in parallel by threads threads, other gzip files are decompressed by a single stream.
+    """
+    if is_bgzf(path):
+        return _bgzf_chunks(path, threads)
+    return _gzip_chunks(path)
+
+
+class ChunkReader(io.RawIOBase):
+    "Read-only binary file reading from an iterator of chunks of data"
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buff = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buff) == 0:
+            self.buff = next(self.chunks, None)
+            if self.buff is None:
+                self.buff = b""
+                return 0
+        n = min(len(b), len(self.buff))
+        b[:n] = self.buff[:n]
+        self.buff = self.buff[n:]
+        return n
+
+    def close(self):
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+        super().close()
+
+
+def open_decompressed(path, threads=4):
+    "Open a gzip or BGZF file for reading bytes, decompressing in background threads"
+    return io.BufferedReader(ChunkReader(decompressed_chunks(path, threads)), buffer_size=READ_SIZE)
+
+
+class DecompressedInput:
+    """Decompress a gzip or BGZF file in a background thread, feeding the data to a pipe.
+
+    The path attribute can be opened by readers of uncompressed files, like pysam.FastxFile.
+    Tracks the amount of data, the elapsed time and the time spent waiting for the reader,
+    which tells whether decompression is the bottleneck.
+    """
+
+    def __init__(self, path, threads=4):
+        self.bytes_in = os.stat(path).st_size
+        self.bytes_out = 0
+        self.wait_time = 0.0
+        self.start_time = time.time()
+        self.end_time = None
+        self.error = None
+        rfd, wfd = os.pipe()
+        try:
+            import fcntl
+            # Larger pipe buffer (Linux only):
+            fcntl.fcntl(wfd, getattr(fcntl, "F_SETPIPE_SZ", 1031), 1 << 20)
+        except (ImportError, OSError):
+            pass
+        self.rfd = rfd
+        _FEEDER_FDS.update((rfd, wfd))
+        self.path = "/dev/fd/{}".format(rfd)
+        self.thread = threading.Thread(target=self._feed, args=(path, threads, wfd), daemon=True)
+        self.thread.start()
+
+    def _feed(self, path, threads, wfd):
+        fh = os.fdopen(wfd, "wb", buffering=0)
+        try:
+            for chunk in decompressed_chunks(path, threads):
+                t = time.time()
+                view = memoryview(chunk)
+                while len(view) > 0:
+                    view = view[fh.write(view):]
+                self.wait_time += time.time() - t
+                self.bytes_out += len(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            _FEEDER_FDS.discard(wfd)
+            fh.close()
+        self.end_time = time.time()
+
+    def close(self):
+        """Close the read end of the pipe and wait for the decompression thread. Processes forked
+        while the file was open can keep the pipe open, so a thread still blocked on writing
+        data nobody reads is left behind.
+        """
+        _FEEDER_FDS.discard(self.rfd)
+        os.close(self.rfd)
+        self.thread.join(timeout=1.0)
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        "Describe the decompression throughput"
+        return report_inputs([self])
+
+
+def report_inputs(inputs):
+    "Describe the combined decompression throughput of several DecompressedInput objects"
+    elapsed = max(sum((inp.end_time or time.time()) - inp.start_time for inp in inputs), 1e-9)
+    bytes_in, bytes_out = sum(inp.bytes_in for inp in inputs), sum(inp.bytes_out for inp in inputs)
+    return "Input decompression: {:.1f} MB from {:.1f} MB in {:.1f}s ({:.1f} MB/s), waiting for the parser {:.0f}% of the time.".format(
+        bytes_out / 1e6, bytes_in / 1e6, elapsed, bytes_out / 1e6 / elapsed, 100 * sum(inp.wait_time for inp in inputs) / elapsed)
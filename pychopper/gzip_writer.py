@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the blocks compressed as gzip members:
+GZIP_BLOCK = 1 << 22
+# Largest BGZF block payload, compressed blocks have to fit in 64 kB:
+BGZF_BLOCK = 65280
+# Empty BGZF block marking the end of the file:
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def _gzip_member(data, level):
+    "Compress a block of data into a gzip member"
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _bgzf_block(data, level):
+    "Compress a block of data into a BGZF block: a gzip member recording its compressed size"
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = comp.compress(data) + comp.flush()
+    # ID1 ID2 CM FLG MTIME XFL OS XLEN, then the BC subfield holding the block size minus one:
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+class ParallelGzipWriter:
+    """Binary file writer compressing blocks of data on a thread pool.
+
+    The output is a series of gzip members, or of BGZF blocks if bgzf is True, which
+    gzip readers decompress as a single stream. zlib releases the GIL, so blocks are
+    compressed concurrently with the rest of the program. Compressed blocks are written
+    in order, at most 4 blocks per thread are pending.
+    """
+
+    def __init__(self, path, threads=4, bgzf=False, level=6):
+        self.fh = open(path, "wb")
+        self.bgzf = bgzf
+        self.level = level
+        self.block_size = BGZF_BLOCK if bgzf else GZIP_BLOCK
+        self.buff = bytearray()
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.max_pending = 4 * threads
+
+    def write(self, data):
+        self.buff += data
+        while len(self.buff) >= self.block_size:
+            block = bytes(self.buff[:self.block_size])
+            del self.buff[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        "Compress a block on the pool, write the blocks compressed so far"
+        self.pending.append(self.pool.submit(_bgzf_block if self.bgzf else _gzip_member, block, self.level))
+        while len(self.pending) > self.max_pending or (len(self.pending) > 0 and self.pending[0].done()):
+            self.fh.write(self.pending.popleft().result())
+
+    def flush(self):
+        "Compress the buffered data and write all pending blocks"
+        if len(self.buff) > 0:
+            self._submit(bytes(self.buff))
+            self.buff = bytearray()
+        while len(self.pending) > 0:
+            self.fh.write(self.pending.popleft().result())
+        self.fh.flush()
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.flush()
+        if self.bgzf:
+            self.fh.write(BGZF_EOF)
+        self.pool.shutdown()
+        self.fh.close()
+
+
+def open_output(path, threads=4):
+    """Open an output file for writing bytes, chosen by extension: BGZF for .bgz/.bgzf,
+    multithreaded gzip for .gz and uncompressed otherwise.
+    """
+    if path.endswith((".bgz", ".bgzf")):
+        return ParallelGzipWriter(path, threads, bgzf=True)
+    if path.endswith(".gz"):
+        return ParallelGzipWriter(path, threads)
+    return open(path, "wb")
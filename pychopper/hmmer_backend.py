@@ -1,59 +1,212 @@
 # -*- coding: utf-8 -*-
 
-import sys
 import os
-import re
+import pty
+import tty
+import threading
+import functools
 import subprocess as sp
-import itertools
+import numpy as np
+from multiprocessing.util import Finalize
 from collections import defaultdict
 from pychopper.common_structures import Hit
 from pychopper import utils
 
+# Per-process nhmmscan coprocess, installed once in each worker by init_worker:
+_WORKER = {}
 
-def _parse_hmmscan_tab(lines, reads):
-    "Prase nhmmscan tabular output"
-    res = []
+# Name of the record terminating each batch sent to nhmmscan:
+SYNC_PREFIX = "__pychopper_sync_"
+# Number of blank lines following the terminating record. It has to be larger than the
+# read buffer of nhmmscan, so the last read of a batch is parsed without waiting for the
+# next batch. Blank lines are not part of the output:
+SYNC_PAD = 16384
+
+
+def _parse_hmmscan_tab(lines):
+    "Parse nhmmscan tabular output, yielding hits"
     for line in lines:
-        line = line.strip()
-        if len(line) == 0:
+        tmp = line.split()
+        if len(tmp) == 0:
             continue
-        if line.startswith('#'):
+        if tmp[0].startswith('#'):
             continue
-        tmp = re.split(r'\s+', line)
-        hit = Hit(tmp[2], int(tmp[6]), int(tmp[7]) + 1, tmp[0], int(tmp[4]), int(tmp[5]) + 1, float(tmp[12]))
-        res.append(hit)
+        yield Hit(tmp[2], int(tmp[6]), int(tmp[7]) + 1, tmp[0], int(tmp[4]), int(tmp[5]) + 1, float(tmp[12]))
+
 
+def _group_hits(hits, reads):
+    "Group hits by read, sequences are named by their index in the batch. Yields the list of hits for each read"
     buff = defaultdict(list)
-    for x, y in itertools.groupby(res, lambda x: x.Ref):
-        buff[x] = list(y)
-    for r in reads:
-        yield buff[r.Id]
+    for hit in hits:
+        buff[int(hit.Ref)].append(hit)
+    for i, r in enumerate(reads):
+        yield [hit._replace(Ref=r.Id) for hit in buff[i]]
+
+
+class NhmmscanProcess:
+    """A long-lived nhmmscan process searching batches of reads passed through its standard input.
+
+    The main and tabular outputs are both written to a pseudo terminal, which makes them
+    line-buffered and keeps their order. The tabular lines of a query come before the // line
+    ending the query in the main output, so a batch is complete once a // line has been read
+    for each of its reads. Each batch is followed by a short record named SYNC_PREFIX and blank
+    lines, which let nhmmscan parse the last read; the output of that record is skipped.
+    """
+
+    def __init__(self, phmm_file, E):
+        if not os.path.isfile(phmm_file):
+            raise Exception("Profile HMM file is invalid: " + phmm_file)
+        self.phmm_file = phmm_file
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        out = "/dev/fd/{}".format(slave)
+        cmd = ["nhmmscan", "--notextw", "--noali", "--max", "-E", str(E), "--cpu", "0", "--watson",
+               "--qformat", "fasta", "-o", out, "--tblout", out, phmm_file, "-"]
+        self.proc = sp.Popen(cmd, stdin=sp.PIPE, pass_fds=(slave,))
+        # Only nhmmscan holds the terminal, reads fail once it exits:
+        os.close(slave)
+        self.output = os.fdopen(master, "rb")
+        self._finalizer = Finalize(self, NhmmscanProcess._shutdown, args=(self.proc, self.output), exitpriority=10)
+
+    def _write_batch(self, reads):
+        "Feed reads followed by the terminating record and the padding to nhmmscan"
+        fh = self.proc.stdin
+        try:
+            for i, read in enumerate(reads):
+                fh.write(">{}\n{}\n".format(i, read.Seq).encode())
+            fh.write(">{}\nN\n{}".format(SYNC_PREFIX, "\n" * SYNC_PAD).encode())
+            fh.flush()
+        except BrokenPipeError:
+            pass
+
+    def _read_batch(self, nr_reads):
+        "Yield the tabular output lines of the next nr_reads queries"
+        query = None
+        done = 0
+        while done < nr_reads:
+            try:
+                line = self.output.readline()
+            except OSError:
+                line = b""
+            if not line:
+                raise Exception("nhmmscan failed with model {}!".format(self.phmm_file))
+            tmp = line.decode().split()
+            if len(tmp) == 0:
+                continue
+            if tmp[0] == "Query:":
+                query = tmp[1]
+            elif tmp[0] == "//":
+                if query != SYNC_PREFIX:
+                    done += 1
+                query = None
+            elif len(tmp) >= 15 and tmp[1] == "-" and tmp[2] == query and query != SYNC_PREFIX:
+                # Tabular hit line: target, accession, query name, ...
+                yield line.decode()
+
+    def search(self, reads):
+        "Search a batch of reads, return the list of hits for each read"
+        if len(reads) == 0:
+            return []
+        # Feed the input from a thread while the output is parsed as it arrives:
+        writer = threading.Thread(target=self._write_batch, args=(reads,))
+        writer.start()
+        try:
+            return list(_group_hits(_parse_hmmscan_tab(self._read_batch(len(reads))), reads))
+        finally:
+            writer.join()
+
+    @staticmethod
+    def _shutdown(proc, output):
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        # Read the output of the last record until nhmmscan exits, so it does not fail writing it:
+        try:
+            while output.read(65536):
+                pass
+        except OSError:
+            pass
+        output.close()
+        proc.wait()
+
+    def close(self):
+        "Terminate the nhmmscan process"
+        self._finalizer()
 
 
-def find_locations(reads, phmm_file, E, pool, min_batch):
-    "Find alignment hits of all primers in all reads using the pHMM/nhmmscan backend"
-    batches = list(utils.batch(reads, min_batch))
-    for res in pool.map(_find_locations_single, zip(batches, [(phmm_file, E, 1)] * len(batches))):
+def init_worker(phmm_file, E, end_window=None):
+    """Start the nhmmscan coprocess of a worker process.
+    If end_window is not None, only that many bases are searched at each end of the reads.
+    """
+    _WORKER["nhmmscan"] = NhmmscanProcess(phmm_file, E)
+    _WORKER["phmm_file"] = phmm_file
+    _WORKER["E"] = E
+    _WORKER["end_window"] = end_window
+
+
+def find_locations(reads, pool, min_batch, max_bases=utils.MAX_BATCH_BASES):
+    """Find alignment hits of all primers in all reads using the pHMM/nhmmscan backend.
+    The pool must have been created with init_worker as initializer. Reads are dispatched in
+    batches of at most min_batch reads and max_bases bases, the largest batches first.
+    """
+    batches = list(utils.batch(reads, min_batch, max_bases))
+    for res in utils.balanced_map(pool, find_batch_locations, batches, [utils.batch_bases(b) for b in batches]):
         for h in res:
             yield list(h)
 
 
-def _find_locations_single(params):
-    "Find alignment hits of all primers in a single reads using the pHMM/nhmmscan backend"
-    reads = params[0]
-    phmm_file, E, threads = params[1]
-    if not os.path.isfile(phmm_file):
-        raise Exception("Profile HMM file is invalid: " + phmm_file)
-    cmd = "nhmmscan --notextw --max -E {} --cpu {} --watson -o /dev/null --tblout /dev/stdout {} -"
-    cmd = cmd.format(E, threads, phmm_file)
-    with sp.Popen(cmd, shell=True, stdin=sp.PIPE, stdout=sp.PIPE) as proc:
-        in_data = ""
-        for read in reads:
-            in_data += ">{}\n{}\n".format(read.Id, read.Seq)
-        dout, derr = proc.communicate(in_data.encode())
-
-    if derr is not None:
-        print("Failed to run hmmscan with model {} and read {}:".format(phmm_file, read.Name), file=sys.stderr)
-        sys.exit(1)
-
-    return list(_parse_hmmscan_tab(dout.decode().split("\n"), reads))
+def find_tune_locations(reads, pool, min_batch, max_bases=utils.MAX_BATCH_BASES, E=None):
+    """Find alignment hits like find_locations for cutoff tuning. In end window mode the reads
+    longer than two windows are searched both in their ends and as a whole, see
+    utils.search_read_ends_all. Yields the hits of each read with their kinds.
+    If E is not None, the reads are searched at that E-value instead of the one of the workers.
+    """
+    batches = list(utils.batch(reads, min_batch, max_bases))
+    find = functools.partial(_find_batch_tune_locations, E=E)
+    for res in utils.balanced_map(pool, find, batches, [utils.batch_bases(b) for b in batches]):
+        yield from res
+
+
+def _find_batch_tune_locations(reads, E=None):
+    """Find alignment hits of all primers in a batch of reads with their kinds, in a worker process.
+    If E is not None, the reads are searched by a new nhmmscan process running at that E-value.
+    """
+    if E is None:
+        return utils.search_read_ends_all(_WORKER["nhmmscan"].search, reads, _WORKER["end_window"])
+    nhmmscan = NhmmscanProcess(_WORKER["phmm_file"], E)
+    try:
+        return utils.search_read_ends_all(nhmmscan.search, reads, _WORKER["end_window"])
+    finally:
+        nhmmscan.close()
+
+
+def near_cutoff(evalues, cutoff):
+    """Check which E-values printed by nhmmscan, rounded to two significant digits, are too close
+    to a cutoff to tell on which side of it the exact E-values are. Returns a mask.
+    """
+    evalues = np.asarray(evalues, dtype=float)
+    # One unit of the last printed digit, twice the rounding error:
+    unit = np.zeros(len(evalues))
+    positive = evalues > 0
+    unit[positive] = 10.0 ** (np.floor(np.log10(evalues[positive])) - 1)
+    return np.abs(evalues - cutoff) <= unit
+
+
+def find_batch_locations(reads):
+    "Find alignment hits of all primers in a batch of reads using the pHMM/nhmmscan backend, in a worker process"
+    return utils.search_read_ends(_WORKER["nhmmscan"].search, reads, _WORKER["end_window"])
+
+
+def find_window_locations(window, offset, read_len):
+    """Find alignment hits of all primers in a window of a long read starting at offset, in a worker process.
+    Hits are returned in read coordinates, with E-values rescaled to the length of the read.
+    """
+    scale = read_len / len(window.Seq)
+    hits = _WORKER["nhmmscan"].search([window])[0]
+    return [utils.shift_hit(h._replace(Score=h.Score * scale), offset) for h in hits if h.Score * scale <= _WORKER["E"]]
+
+
+def merge_window_hits(window_results):
+    "Merge the results of find_window_locations on the windows of a read"
+    return utils.dedup_hits([h for res in window_results for h in res])
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import parasail
-import re
 from pychopper.common_structures import Hit
 
 # Fixme: allow setting this from the command line?
@@ -10,13 +9,17 @@ DEFAULT_ALIGN_PARAMS = {'match': 1,
                         'gap_open': 1,
                         'gap_extend': 1}
 DEFAULT_SUBS_MAT = parasail.matrix_create("ACGT", DEFAULT_ALIGN_PARAMS['match'], DEFAULT_ALIGN_PARAMS['mismatch'])
-re_split_cigar = re.compile(r"(?P<len>\d+)(?P<op>\D+)")
+# Parasail encodes cigar operations like BAM, length in the upper 28 bits:
+CIGAR_OPS = 'MIDNSHP=X'
 
 
 def first_cigar(cigar):
-    """Extract details of the first operation in a cigar string."""
-    m = re.search(re_split_cigar, cigar)
-    return int(m.group('len')), m.group('op')
+    """Extract details of the first operation of a parasail cigar, without decoding it to a string."""
+    c = cigar.pointer[0]
+    if c.len == 0:
+        return 0, None
+    op = c.seq[0]
+    return op >> 4, CIGAR_OPS[op & 0xf]
 
 
 def process_alignment(aln, query, query_name, aln_params):
@@ -27,10 +30,11 @@ def process_alignment(aln, query, query_name, aln_params):
     res['score'] = aln.score
     max_score = float(aln_params['match'] * len(query))
     res['norm_score'] = (max_score - aln.score) / max_score
-    fo = first_cigar(aln.cigar.decode.decode())
-    res['ref_start'] = aln.cigar.beg_ref
+    cigar = aln.cigar
+    fo = first_cigar(cigar)
+    res['ref_start'] = cigar.beg_ref
     res['ref_end'] = aln.end_ref + 1
-    res['query_start'] = aln.cigar.beg_query
+    res['query_start'] = cigar.beg_query
     res['query_end'] = aln.end_query + 1
     if fo[1] == 'I':
         res['query_start'] += fo[0]
@@ -39,19 +43,32 @@ def process_alignment(aln, query, query_name, aln_params):
     return res
 
 
-def pair_align(reference, query, query_name, subs_mat, params):
-    """ Perform pairwise local alignment using parsail-python """
-    aln = parasail.sw_trace_striped_32(query, reference, params['gap_open'], params['gap_extend'], subs_mat)
+def create_profiles(all_primers, subs_mat=DEFAULT_SUBS_MAT):
+    """ Build 16-bit query profiles for all primers, to be reused across alignments """
+    return {acc: parasail.profile_create_16(seq, subs_mat) for acc, seq in all_primers.items()}
+
+
+def pair_align(reference, query, query_name, subs_mat, params, profile=None):
+    """ Perform pairwise local alignment using parsail-python.
+    The 16-bit kernel is used first, the alignment is repeated with the 32-bit kernel if the score overflows.
+    """
+    if profile is None:
+        aln = parasail.sw_trace_striped_16(query, reference, params['gap_open'], params['gap_extend'], subs_mat)
+    else:
+        aln = parasail.sw_trace_striped_profile_16(profile, reference, params['gap_open'], params['gap_extend'])
+    if aln.saturated:
+        aln = parasail.sw_trace_striped_32(query, reference, params['gap_open'], params['gap_extend'], subs_mat)
     return process_alignment(aln, query, query_name, params)
 
 
-def refine_locations(read, all_primers, locations, aln_params=DEFAULT_ALIGN_PARAMS, subs_mat=DEFAULT_SUBS_MAT):
+def refine_locations(read, all_primers, locations, aln_params=DEFAULT_ALIGN_PARAMS, subs_mat=DEFAULT_SUBS_MAT, profiles=None):
     "Refine alignment edges based on local alignment"
     seq = read.Seq
 
     proc_locations = []
     for loc in locations:
-        aln = pair_align(seq[loc.RefStart:loc.RefEnd], all_primers[loc.Query], loc.Query, subs_mat, aln_params)
+        profile = profiles[loc.Query] if profiles is not None else None
+        aln = pair_align(seq[loc.RefStart:loc.RefEnd], all_primers[loc.Query], loc.Query, subs_mat, aln_params, profile)
         rscore = aln['norm_score']
         rloc = Hit(loc.Ref, loc.RefStart + aln["ref_start"], loc.RefStart + aln["ref_end"], loc.Query, aln["query_start"], aln["query_end"], rscore)
         proc_locations.append(rloc)
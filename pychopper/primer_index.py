@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# 2-bit codes of the bases, all other characters are invalid (4):
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate("ACGT"):
+    _BASE_CODES[ord(_b)] = _i
+    _BASE_CODES[ord(_b.lower())] = _i
+
+
+# Largest supported k-mer length, the index holds a table of 4^k entries:
+MAX_K = 12
+
+
+def kmer_codes(seq, k):
+    "Encode all k-mers of a sequence as integers, k-mers containing non-ACGT bases are encoded as 4^k"
+    n = len(seq) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int32)
+    vals = _BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    codes = np.zeros(n, dtype=np.int32)
+    for j in range(k):
+        codes <<= 2
+        codes |= vals[j:j + n] & 3
+    invalid = vals > 3
+    if invalid.any():
+        nr_invalid = np.concatenate(([0], np.cumsum(invalid)))
+        codes[nr_invalid[k:] > nr_invalid[:n]] = 4 ** k
+    return codes
+
+
+class PrimerIndex:
+    """Index of the k-mers of primer sequences.
+
+    Used to find the windows of a read which contain enough exact k-mer (seed) matches of a
+    primer to be worth aligning. The index is a table of the primers containing each k-mer,
+    stored as bit masks.
+    """
+
+    def __init__(self, primers, k, min_seeds=2):
+        if not 0 < k <= MAX_K:
+            raise Exception("Seed k-mer length must be between 1 and {}!".format(MAX_K))
+        if len(primers) > 64:
+            raise Exception("The seed index supports at most 64 primers!")
+        self.k = k
+        self.min_seeds = min_seeds
+        self.lengths = {acc: len(seq) for acc, seq in primers.items()}
+        self.bits = {acc: np.uint64(1 << i) for i, acc in enumerate(primers)}
+        # The last entry is the code of invalid k-mers:
+        self.table = np.zeros(4 ** k + 1, dtype=np.uint64)
+        for acc, seq in primers.items():
+            self.table[kmer_codes(seq, k)] |= self.bits[acc]
+        self.table[-1] = 0
+
+    def read_seeds(self, seq):
+        "Find the k-mers of a read present in any primer, return their positions and primer bit masks"
+        masks = self.table[kmer_codes(seq, self.k)]
+        pos = np.flatnonzero(masks)
+        return pos, masks[pos]
+
+    def windows(self, seeds, acc, max_ed):
+        """Find the windows of a read around clusters of at least min_seeds seed matches of a primer.
+        Windows are padded so they contain any alignment with at most max_ed edits overlapping
+        the seeds. Returns a list of sorted, non-overlapping (start, end) tuples.
+        """
+        pos, masks = seeds
+        pos = pos[(masks & self.bits[acc]) != 0]
+        if len(pos) < self.min_seeds:
+            return []
+        # Seeds of the same primer occurrence are at most this far apart:
+        span = self.lengths[acc] + max_ed
+        res = []
+        for cluster in np.split(pos, np.flatnonzero(np.diff(pos) > span) + 1):
+            if len(cluster) < self.min_seeds:
+                continue
+            start = max(int(cluster[0]) - span, 0)
+            end = int(cluster[-1]) + self.k + span
+            if len(res) > 0 and start <= res[-1][1]:
+                res[-1] = (res[-1][0], end)
+            else:
+                res.append((start, end))
+        return res
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from multiprocessing import shared_memory
+from multiprocessing.util import Finalize
+import numpy as np
+
+from pychopper.common_structures import Seq
+
+# Fields of the reads stored in a packed batch:
+_FIELDS = ("Id", "Name", "Seq", "Qual")
+
+
+# Shared memory blocks of freed batches, reused by the next batches to avoid the cost of
+# mapping new memory. At most _MAX_FREE_BLOCKS are kept. Batches are packed by several reader
+# threads and released by the garbage collector in any thread, hence the (reentrant) lock:
+_FREE_BLOCKS = []
+_MAX_FREE_BLOCKS = 16
+_FREE_LOCK = threading.RLock()
+
+
+def _free_all():
+    "Unlink the cached shared memory blocks at exit"
+    while len(_FREE_BLOCKS) > 0:
+        shm = _FREE_BLOCKS.pop()
+        shm.close()
+        shm.unlink()
+
+
+_FREE_ALL = Finalize(None, _free_all, exitpriority=10)
+
+
+def _get_block(size):
+    "Get a shared memory block of at least size bytes, sizes are rounded up to powers of two"
+    with _FREE_LOCK:
+        for i, shm in enumerate(_FREE_BLOCKS):
+            if shm.size >= size:
+                return _FREE_BLOCKS.pop(i)
+    return shared_memory.SharedMemory(create=True, size=1 << max(size - 1, 1).bit_length())
+
+
+def _release(shm):
+    "Free a shared memory block created by PackedReads.pack, keeping it for reuse if possible"
+    with _FREE_LOCK:
+        if len(_FREE_BLOCKS) < _MAX_FREE_BLOCKS:
+            _FREE_BLOCKS.append(shm)
+            return
+    shm.close()
+    shm.unlink()
+
+
+class PackedReads:
+    """A batch of reads packed into a single shared memory block.
+
+    The block holds the end offsets of the fields of all reads, a flag telling whether each read
+    has qualities and the concatenated fields. Only the name of the block is pickled, so
+    batches are passed to worker processes without serializing the reads. The block is
+    released for reuse once the PackedReads created by pack is garbage collected.
+    """
+
+    def __init__(self, shm, nr_reads):
+        self.shm = shm
+        self.nr_reads = nr_reads
+
+    @classmethod
+    def pack(cls, reads):
+        "Pack a list of reads into a shared memory block"
+        fields = [(f or "").encode() for read in reads for f in (read.Id, read.Name, read.Seq, read.Qual)]
+        ends = np.cumsum([0] + [len(f) for f in fields], dtype=np.int64)
+        has_qual = np.array([read.Qual is not None for read in reads], dtype=np.uint8)
+        header = ends.nbytes + has_qual.nbytes
+        shm = _get_block(header + int(ends[-1]))
+        buf = shm.buf
+        buf[:ends.nbytes] = ends.tobytes()
+        buf[ends.nbytes:header] = has_qual.tobytes()
+        for start, end, f in zip((header + ends[:-1]).tolist(), (header + ends[1:]).tolist(), fields):
+            buf[start:end] = f
+        del buf
+        res = cls(shm, len(reads))
+        res._finalizer = Finalize(res, _release, args=(shm,))
+        return res
+
+    def __len__(self):
+        return self.nr_reads
+
+    def __reduce__(self):
+        return (PackedReads._attach, (self.shm.name, self.nr_reads))
+
+    @classmethod
+    def _attach(cls, name, nr_reads):
+        "Attach to the shared memory block of a batch packed in another process"
+        return cls(shared_memory.SharedMemory(name=name), nr_reads)
+
+    def unpack(self):
+        """Decode the reads of the batch, return a list of Seq tuples.
+        Fields are decoded straight from the shared memory block.
+        """
+        n = self.nr_reads
+        buf = self.shm.buf
+        ends = np.frombuffer(buf, dtype=np.int64, count=len(_FIELDS) * n + 1).tolist()
+        has_qual = np.frombuffer(buf, dtype=np.uint8, count=n, offset=8 * len(ends)).tolist()
+        base = 8 * len(ends) + n
+        data = buf[base:base + ends[-1]]
+        fields = [str(data[start:end], "utf-8") for start, end in zip(ends, ends[1:])]
+        del data
+        res = []
+        for i in range(n):
+            read_id, name, seq, qual = fields[4 * i:4 * i + 4]
+            res.append(Seq(read_id, name, seq, qual if has_qual[i] else None, None))
+        return res
+
+    def close(self):
+        "Detach from the shared memory block, without freeing it"
+        self.shm.close()
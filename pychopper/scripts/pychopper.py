@@ -4,17 +4,22 @@
 import argparse
 import os
 import io
+import mmap
 import sys
 import numpy as np
 import pandas as pd
 from collections import OrderedDict, defaultdict
 import concurrent.futures
 import tqdm
-import gzip
+import functools
+import itertools
 
 from pychopper import seq_utils as seu
 from pychopper import utils
-from pychopper import chopper, report
+from pychopper import chopper, report, edlib_backend, hmmer_backend, primer_index
+from pychopper.read_batch import PackedReads
+from pychopper.gzip_writer import open_output
+from pychopper.gzip_reader import is_gzip, open_decompressed, report_inputs
 import pychopper.phmm_data as phmm_data
 import pychopper.primer_data as primer_data
 
@@ -42,7 +47,7 @@ def _update_stats(st, d_fh, segments, hits, usable_len, read):
     "Update stats dictionary with properties of a read"
     st["PassReads"] += 1
     if len(hits) > 0:
-        h = ",".join([x.Query for x in hits])
+        h = ",".join(hits.queries)
         st["Hits"][h] += 1
     if len(segments) == 0:
         st["Classification"]["Unusable"] += 1
@@ -67,6 +72,143 @@ def _update_stats(st, d_fh, segments, hits, usable_len, read):
         st["RescueSegmentNr"][len(segments)] += 1
 
 
+def _merge_stats(st, part):
+    "Add the counts of a partial stats dictionary to a stats dictionary"
+    for k, v in part.items():
+        if isinstance(v, dict):
+            for kk, vv in v.items():
+                st[k][kk] += vv
+        else:
+            st[k] += v
+
+
+# Output streams of the records formatted by the workers:
+OUTPUT_STREAMS = ("out", "u", "l", "w", "A", "D", "K")
+
+
+def _process_batch(params):
+    """Process a batch of reads in a worker process: mean quality filtering, primer search,
+    segmentation, trimming, reverse complementing, length filtering and formatting of the
+    output records. Returns the encoded records of each output stream (None if the stream
+    is disabled) and the stats of the batch.
+    """
+    locate, reads, config, cutoff, opts = params
+    st = _new_stats()
+    bufs = {k: io.StringIO() if opts[k] else None for k in OUTPUT_STREAMS}
+    out_fh, u_fh, l_fh, w_fh, a_fh, d_fh, k_fh = (bufs[k] for k in OUTPUT_STREAMS)
+    if opts["Q"] is not None and len(reads) > 0:
+        # Reads without qualities (fasta input) are not filtered:
+        passed = [not read.Qual or bool(mq >= opts["Q"]) for read, mq in zip(reads, seu.mean_quals([read.Qual for read in reads]))]
+        if k_fh is not None:
+            for read in (read for read, ok in zip(reads, passed) if not ok):
+                seu.writefq(read, k_fh)
+        st["QcFail"] += passed.count(False)
+        reads = [read for read, ok in zip(reads, passed) if ok]
+    for read, (segments, hits, usable_len), umis in chopper.chopper_batch(locate, reads, config, cutoff, opts["U"]):
+        if a_fh is not None:
+            a_fh.write(utils.hits2bed(hits, read))
+        _update_stats(st, d_fh, segments, hits, usable_len, read)
+        if u_fh is not None and len(segments) == 0:
+            seu.writefq(read, u_fh)
+        for trim_read in chopper.segments_to_reads(read, segments, opts["p"], opts["y"], umis):
+            if trim_read.Umi:
+                st["Umi_detected"] += 1
+            if len(trim_read.Seq) < opts["z"]:
+                st["LenFail"] += 1
+                if l_fh is not None:
+                    seu.writefq(trim_read, l_fh)
+                continue
+            if len(segments) == 1:
+                if trim_read.Umi:
+                    st["Umi_detected_final"] += 1
+                seu.writefq(trim_read, out_fh)
+            if w_fh is not None and len(segments) > 1:
+                seu.writefq(trim_read, w_fh)
+    return {k: None if b is None else b.getvalue().encode() for k, b in bufs.items()}, st
+
+
+def _is_windowed(opts, window_len, read):
+    "Check whether a read is split into windows searched in parallel"
+    # Long reads failing the quality filter are not searched, the workers filter them:
+    return window_len is not None and len(read.Seq) > 2 * window_len and \
+        (opts["Q"] is None or not read.Qual or seu.mean_qual(read.Qual) >= opts["Q"])
+
+
+def _pipeline_tasks(batches, params, window_len, find_window, long_reads, long_keys):
+    """Build the tasks of the processing pipeline from batches of reads, params being the arguments
+    of _process_batch other than the reads. Batches are passed to the workers in shared memory.
+    Reads longer than twice window_len are split into overlapping windows searched by separate
+    tasks, and kept in long_reads until all their windows are searched, under a key taken from
+    the long_keys counter (shared by the readers of all input files).
+    """
+    locate, config, cutoff, opts = params
+    for reads in batches:
+        short = []
+        for read in reads:
+            if not _is_windowed(opts, window_len, read):
+                short.append(read)
+                continue
+            # Tasks are yielded in input order:
+            if len(short) > 0:
+                yield "batch", (locate, PackedReads.pack(short), config, cutoff, opts)
+                short = []
+            windows = utils.read_windows(read, window_len)
+            key = next(long_keys)
+            long_reads[key] = read
+            for offset, window in windows:
+                yield "window", (find_window, key, len(windows), offset, window, len(read.Seq))
+        if len(short) > 0:
+            yield "batch", (locate, PackedReads.pack(short), config, cutoff, opts)
+
+
+def _range_tasks(fastq, range_size, params, window_len):
+    """Build the tasks of the processing pipeline from byte ranges of an uncompressed fastq file,
+    parsed by the workers. params are the arguments of _process_batch other than the reads.
+    """
+    locate, config, cutoff, opts = params
+    size = os.stat(fastq).st_size
+    for start in range(0, size, range_size):
+        yield "range", (locate, fastq, start, min(start + range_size, size), config, cutoff, opts, window_len)
+
+
+def _process_range(params):
+    """Parse the records starting in a byte range of a memory mapped fastq file in a worker process
+    and process them. Returns a list of processed batches and of long reads to be split into windows,
+    in input order.
+    """
+    locate, fastq, start, end, config, cutoff, opts, window_len = params
+    with open(fastq, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        reads = seu.readfq_range(buf, start, end)
+    res, short = [], []
+    for read in reads:
+        if not _is_windowed(opts, window_len, read):
+            short.append(read)
+            continue
+        if len(short) > 0:
+            res.append(("batch", _process_batch((locate, short, config, cutoff, opts))))
+            short = []
+        res.append(("long", read))
+    if len(short) > 0 or len(res) == 0:
+        res.append(("batch", _process_batch((locate, short, config, cutoff, opts))))
+    return res
+
+
+def _run_task(task):
+    """Run a task of the processing pipeline in a worker process: a batch of reads, a byte range
+    of the input or a window of a long read.
+    """
+    kind, params = task
+    if kind == "batch":
+        locate, packed, config, cutoff, opts = params
+        reads = packed.unpack()
+        packed.close()
+        return kind, _process_batch((locate, reads, config, cutoff, opts))
+    if kind == "range":
+        return kind, _process_range(params)
+    find_window, key, nr_windows, offset, window, read_len = params
+    return kind, (key, nr_windows, find_window(window, offset, read_len))
+
+
 def _process_stats(st):
     "Convert stats dictionary into a data frame"
     res = OrderedDict([("Category", []), ("Name", []), ("Value", [])])
@@ -208,13 +350,13 @@ def _plot_stats(st, pdf, q, q_bak, detect_umi):
     R.close()
 
 
-def _opener(filename, mode, encoding='utf8'):
+def _opener(filename, mode, encoding='utf8', threads=4):
     if filename == '-':
         sys.stderr.write("Reading from stdin\n")
         #return open(sys.stdin.buff, mode, encoding=encoding)
         return io.TextIOWrapper(sys.stdin.buffer, encoding=encoding)
-    elif filename.endswith('.gz'):
-        return gzip.open(filename, mode + 't', encoding=encoding)
+    elif is_gzip(filename):
+        return io.TextIOWrapper(open_decompressed(filename, threads), encoding=encoding)
     else:
         return open(filename, mode, encoding=encoding)
 
@@ -244,10 +386,14 @@ def main():
         help="Cutoff parameter (autotuned).")
     parser.add_argument(
         '-Q', metavar='min_qual', type=float, default=7.0,
-        help="Minimum mean base quality (7.0).")
+        help="Minimum mean base quality, reads without qualities are not filtered (7.0).")
     parser.add_argument(
         '-z', metavar='min_len', type=int, default=50,
         help="Minimum segment length (50).")
+    parser.add_argument(
+        '-o', metavar='output', type=str, default=None,
+        help="Output file, all positional arguments are inputs. Needed with more than one input argument, "
+             "use - for the standard output.")
     parser.add_argument(
         '-r', metavar='report_pdf', type=str,
         default="pychopper.pdf",
@@ -292,6 +438,10 @@ def main():
     parser.add_argument(
         '-B', metavar='batch_size', type=int, default=10000,
         help="Maximum number of reads processed in each batch (10000).")
+    parser.add_argument(
+        '--batch-bases', metavar='batch_bases', type=int, default=utils.MAX_BATCH_BASES,
+        help="Maximum number of bases in the batches processed by the workers, "
+             "longer reads are processed on their own ({}).".format(utils.MAX_BATCH_BASES))
     parser.add_argument(
         '-D', metavar='read stats', type=str, default=None,
         help="Tab separated file with per-read stats (None).")
@@ -301,13 +451,72 @@ def main():
     parser.add_argument(
         '-U', action='store_true', default=False,
         help="Detect UMIs")
+    parser.add_argument(
+        '--end-window', metavar='end_window', type=int, default=None,
+        help="Search primers only in this many bases at each end of the reads, "
+             "searching the whole read if fewer than two hits are found (None).")
+    parser.add_argument(
+        '--seed-k', metavar='seed_k', type=int, default=None,
+        help="Align primers only to read windows with at least two exact k-mer matches of this length "
+             "with the primer, skipping reads without such windows (edlib backend only, None).")
+    parser.add_argument(
+        '--long-window', metavar='long_window', type=int, default=100000,
+        help="Split reads longer than twice this length into overlapping windows searched in parallel, "
+             "0 to disable, otherwise larger than 1000. Not used with --end-window (100000).")
+    parser.add_argument(
+        '--compress-threads', metavar='compress_threads', type=int, default=4,
+        help="Number of threads compressing each output file ending in .gz (gzip) or .bgz (BGZF) (4).")
+    parser.add_argument(
+        '--decompress-threads', metavar='decompress_threads', type=int, default=4,
+        help="Number of threads decompressing gzip or BGZF input, BGZF blocks are decompressed in parallel (4).")
+    parser.add_argument(
+        '--no-mmap', action='store_true', default=False,
+        help="Parse uncompressed fastq input in a single reader thread, instead of in byte ranges mapped by the workers.")
+    parser.add_argument(
+        '--readers', metavar='readers', type=int, default=4,
+        help="Number of input files read concurrently, ahead of the one being processed (4).")
+    parser.add_argument(
+        '--depth', metavar='depth', type=int, default=None,
+        help="Maximum number of batches in flight between the reader, the workers and the writer (2 x threads).")
+    parser.add_argument(
+        '--unordered', action='store_true', default=False,
+        help="Write the results of batches as they complete instead of in input order.")
 
-    parser.add_argument('input_fastx', metavar='input_fastx', type=str,
-                        help="Input file.")
+    parser.add_argument('input_fastx', metavar='input_fastx', type=str, nargs="+",
+                        help="Input files, directories (searched for fastx files) or glob patterns.")
     parser.add_argument('output_fastx', metavar='output_fastx', nargs="?",
-                        type=str, default="-", help="Output file.")
+                        type=str, default="-", help="Output file when exactly two positional arguments are given and -o is not used (stdout).")
 
     args = parser.parse_args()
+    # The input files take all positional arguments:
+    if args.o is not None:
+        args.output_fastx = args.o
+    elif len(args.input_fastx) == 2:
+        args.output_fastx = args.input_fastx.pop()
+    elif len(args.input_fastx) > 2:
+        sys.exit('Use -o to give the output of several inputs')
+    args.input_fastx = utils.expand_inputs(args.input_fastx)
+    for output in (args.output_fastx, args.r, args.u, args.l, args.w, args.S, args.A, args.D, args.K):
+        if output is not None and os.path.exists(output) and any(
+                fastq != "-" and os.path.samefile(output, fastq) for fastq in args.input_fastx):
+            sys.exit('Output file {} is also an input'.format(output))
+    input_noun = "input file" if len(args.input_fastx) == 1 else "{} input files".format(len(args.input_fastx))
+    input_desc = "{}: {}".format(input_noun, args.input_fastx[0]) if len(args.input_fastx) == 1 else input_noun
+
+    if args.long_window != 0 and args.long_window <= utils.WINDOW_OVERLAP:
+        sys.exit(
+            '--long-window should be 0 or larger than the overlap of the windows ({})'.format(utils.WINDOW_OVERLAP)
+        )
+    if args.end_window is not None and args.end_window <= 0:
+        sys.exit('--end-window should be larger than 0')
+    if args.batch_bases <= 0:
+        sys.exit('--batch-bases should be larger than 0')
+    if args.seed_k is not None and not 0 < args.seed_k <= primer_index.MAX_K:
+        sys.exit('--seed-k should be between 1 and {}'.format(primer_index.MAX_K))
+    if args.compress_threads < 1:
+        sys.exit('--compress-threads should be at least 1')
+    if args.decompress_threads < 1:
+        sys.exit('--decompress-threads should be at least 1')
 
     if args.m == "phmm":
         utils.check_command("nhmmscan -h > /dev/null")
@@ -379,35 +588,40 @@ def main():
     sys.stderr.write("Using kit: {}\n".format(args.b if args.b else args.k))
     sys.stderr.write("Configurations to consider: \"{}\"\n".format(CONFIG))
 
-    out_fh = sys.stdout
+    # Records are formatted and encoded by the workers, outputs are compressed by extension:
+    out_fh = sys.stdout.buffer
     if args.output_fastx != '-':
-        out_fh = open(args.output_fastx, "w")
+        out_fh = open_output(args.output_fastx, args.compress_threads)
 
     u_fh = None
     if args.u is not None:
-        u_fh = open(args.u, "w")
+        u_fh = open_output(args.u, args.compress_threads)
 
     l_fh = None
     if args.l is not None:
-        l_fh = open(args.l, "w")
+        l_fh = open_output(args.l, args.compress_threads)
 
     w_fh = None
     if args.w is not None:
-        w_fh = open(args.w, "w")
+        w_fh = open_output(args.w, args.compress_threads)
 
     a_fh = None
     if args.A is not None:
-        a_fh = open(args.A, "w")
+        a_fh = open_output(args.A, args.compress_threads)
 
     d_fh = None
     if args.D is not None:
-        d_fh = open(args.D, "w")
-        d_fh.write("Read\tLength\tStatus\tStart\tEnd\tStrand\n")
+        d_fh = open_output(args.D, args.compress_threads)
+        d_fh.write(b"Read\tLength\tStatus\tStart\tEnd\tStrand\n")
+
+    k_fh = None
+    if args.K is not None:
+        k_fh = open_output(args.K, args.compress_threads)
 
     st = _new_stats()
     input_size = None
-    if args.input_fastx != "-":
-        input_size = os.stat(args.input_fastx).st_size
+    if "-" not in args.input_fastx:
+        input_size = sum(os.stat(fastq).st_size for fastq in args.input_fastx)
 
     if args.q is None and args.Y <= 0:
         sys.stderr.write("Please specifiy either -q or -Y!")
@@ -416,12 +630,32 @@ def main():
         all_primers = seu.get_primers(args.b)
 
     if args.m == "phmm":
-        def backend(x, pool, q=None, mb=None):
-            return chopper.chopper_phmm(x, args.g, config, q, args.t, pool, mb)
+        search_backend = hmmer_backend
+
+        def new_pool(q):
+            # Each worker runs its own nhmmscan process for the whole run:
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.t, initializer=hmmer_backend.init_worker,
+                initargs=(args.g, q, args.end_window))
+
+        def tune_backend(x, cutoffs, mb):
+            # Run nhmmscan once at the loosest E-value and filter the hits for the rest:
+            with new_pool(max(cutoffs)) as pool:
+                yield from chopper.chopper_phmm_tune(x, config, cutoffs, pool, mb, args.batch_bases)
     elif args.m == "edlib":
-        def backend(x, pool, q=None, mb=None):
-            return chopper.chopper_edlib(x, all_primers, config, q * 1.2, q,
-                                         pool, mb)
+        search_backend = edlib_backend
+
+        def new_pool(q):
+            # Primers and alignment profiles are installed once per worker:
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.t, initializer=edlib_backend.init_worker,
+                initargs=(all_primers, q * 1.2, args.end_window, args.seed_k))
+
+        def tune_backend(x, cutoffs, mb):
+            # Align once at the loosest cutoff and replay the rest in memory:
+            with new_pool(max(cutoffs)) as pool:
+                yield from chopper.chopper_edlib_tune(
+                    x, all_primers, config, cutoffs, cutoffs * 1.2, pool, mb, args.batch_bases)
     else:
         raise Exception("Invalid backend!")
 
@@ -439,8 +673,8 @@ def main():
             cutoffs = np.linspace(10 ** -5, 5.0, num=nr_cutoffs)
         class_reads = []
         class_readLens = []
-        nr_records = utils.count_fastq_records(args.input_fastx,
-                                               opener=_opener)
+        nr_records = sum(utils.count_fastq_records(fastq, opener=functools.partial(_opener, threads=args.decompress_threads))
+                         for fastq in args.input_fastx)
         opt_batch = int(nr_records / args.t)
         if opt_batch < args.B:
             args.B = opt_batch
@@ -449,27 +683,24 @@ def main():
             target_prop = args.Y / float(nr_records)
         if target_prop > 1.0:
             target_prop = 1.0
-        sys.stderr.write("Counting fastq records in input file: {}\n".format(
-            args.input_fastx))
+        sys.stderr.write("Counting fastq records in {}\n".format(input_desc))
         sys.stderr.write(
-            "Total fastq records in input file: {}\n".format(nr_records))
-        read_sample = list(
-            seu.readfq(args.input_fastx, sample=target_prop, min_qual=args.Q))
+            "Total fastq records in {}: {}\n".format(input_noun, nr_records))
+        read_sample = [read for fastq in args.input_fastx for read in
+                       seu.readfq(fastq, sample=target_prop, min_qual=args.Q, threads=args.decompress_threads)]
         sys.stderr.write(
             "Tuning the cutoff parameter (q) on {} sampled reads ({:.1f}%) passing quality filters (Q >= {}).\n".format(
                 len(read_sample), target_prop * 100.0, args.Q))
         sys.stderr.write("Optimizing over {} cutoff values.\n".format(args.L))
-        for qv in tqdm.tqdm(cutoffs):
+        tune_batch = max(1000, int((len(read_sample)) / args.t))
+        for qv, results in tqdm.tqdm(tune_backend(read_sample, cutoffs, tune_batch), total=len(cutoffs)):
             clsLen = 0
             cls = 0
-            with concurrent.futures.ProcessPoolExecutor(max_workers=args.t) as executor:
-                for batch in utils.batch(read_sample, int((len(read_sample)))):
-                    for read, (segments, hits, usable_len) \
-                            in backend(batch, executor, qv, max(1000, int((len(read_sample)) / args.t))):
-                        flt = list([x.Len for x in segments if x.Len > 0])
-                        if len(flt) == 1:
-                            clsLen += sum(flt)
-                            cls += 1
+            for read, (segments, hits, usable_len) in results:
+                flt = list([x.Len for x in segments if x.Len > 0])
+                if len(flt) == 1:
+                    clsLen += sum(flt)
+                    cls += 1
             class_reads.append(cls)
             class_readLens.append(clsLen)
         best_qi = np.argmax(class_readLens)
@@ -501,44 +732,73 @@ def main():
             args.B))
     pbar = tqdm.tqdm(total=input_size)
     min_batch_size = max(int(args.B / args.t), 1)
-    rfq_sup = {"out_fq": args.K, "pass": 0, "total": 0}
-    with concurrent.futures.ProcessPoolExecutor(
-            max_workers=args.t) as executor:
-        for batch in utils.batch(
-                seu.readfq(args.input_fastx, min_qual=args.Q, rfq_sup=rfq_sup), args.B):
-            for read, (segments, hits, usable_len) in backend(batch, executor,
-                                                              q=args.q,
-                                                              mb=min_batch_size):
-                if args.A is not None:
-                    for h in hits:
-                        a_fh.write(utils.hit2bed(h, read) + "\n")
-                _update_stats(st, d_fh, segments, hits, usable_len, read)
-                if args.u is not None and len(segments) == 0:
-                    seu.writefq(read, u_fh)
-                for trim_read in chopper.segments_to_reads(read, segments,
-                                                           args.p, args.y, args.U):
-                    if trim_read.Umi:
-                        st["Umi_detected"] += 1
-                    if len(trim_read.Seq) < args.z:
-                        st["LenFail"] += 1
-                        if args.l is not None:
-                            seu.writefq(trim_read, l_fh)
-                        continue
-                    if len(segments) == 1:
-                        if trim_read.Umi:
-                            st["Umi_detected_final"] += 1
-                        seu.writefq(trim_read, out_fh)
-                    if args.w is not None and len(segments) > 1:
-                        seu.writefq(trim_read, w_fh)
-                #if nr_records is None:
-                #    pbar.update(seu.record_size(read, 'fastq'))
-                #else:
-                pbar.update(1)
+    outputs = {"out": out_fh, "u": u_fh, "l": l_fh, "w": w_fh, "A": a_fh, "D": d_fh, "K": k_fh}
+    opts = {k: fh is not None for k, fh in outputs.items()}
+    # The mean quality filter is evaluated by the workers:
+    opts.update(p=args.p, y=args.y, z=args.z, U=args.U, Q=args.Q)
+    depth = args.depth if args.depth is not None else 2 * args.t
+    window_len = args.long_window if args.long_window > 0 and args.end_window is None else None
+    rfq_sups, reader_timings, parsed_inputs = [], [], []
+    long_reads, long_keys, window_results = {}, itertools.count(), defaultdict(list)
+    params = (search_backend.find_batch_locations, config, args.q, opts)
+
+    def input_tasks(fastq):
+        "Build the pipeline tasks reading an input file"
+        if not args.no_mmap and fastq != "-" and not is_gzip(fastq) and seu.is_fastq(fastq):
+            # The workers parse byte ranges of the memory mapped input:
+            parsed_inputs.append(False)
+            return _range_tasks(fastq, 2 * args.batch_bases, params, window_len)
+        parsed_inputs.append(True)
+        rfq_sups.append({"input": None})
+        batches = utils.batch(seu.readfq(fastq, min_qual=None, rfq_sup=rfq_sups[-1], threads=args.decompress_threads),
+                              min_batch_size, args.batch_bases)
+        return _pipeline_tasks(batches, params, window_len, search_backend.find_window_locations, long_reads, long_keys)
+
+    with new_pool(args.q) as executor:
+        utils.start_workers(executor)
+        # Pipeline stages: input parsing in reader threads, each reading an input file ahead of the
+        # previous ones, tasks submitted to the workers from another thread while this one writes
+        # the results and merges the stats of all inputs:
+        tasks = utils.chain_background((input_tasks(fastq) for fastq in args.input_fastx), args.readers, depth, reader_timings)
+        map_tasks = utils.unordered_map if args.unordered else utils.ordered_map
+        results = map_tasks(executor, _run_task, tasks, depth)
+        for kind, res in utils.background_iter(results, depth):
+            if kind == "window":
+                key, nr_windows, window_res = res
+                window_results[key].append(window_res)
+                if len(window_results[key]) < nr_windows:
+                    continue
+                # All windows of a long read are searched, it is segmented and formatted here:
+                hits = search_backend.merge_window_hits(window_results.pop(key))
+                res = _process_batch((lambda reads: [hits], [long_reads.pop(key)], config, args.q, opts))
+            for piece_kind, piece in res if kind == "range" else [(kind, res)]:
+                if piece_kind == "long":
+                    # Long reads found by the workers parsing byte ranges, their windows are searched in parallel:
+                    windows = utils.read_windows(piece, window_len)
+                    futures = [executor.submit(search_backend.find_window_locations, window, offset, len(piece.Seq))
+                               for offset, window in windows]
+                    hits = search_backend.merge_window_hits([f.result() for f in futures])
+                    piece = _process_batch((lambda reads: [hits], [piece], config, args.q, opts))
+                bufs, part = piece
+                for k, fh in outputs.items():
+                    if fh is not None:
+                        fh.write(bufs[k])
+                _merge_stats(st, part)
+                pbar.update(part["PassReads"] + part["QcFail"])
     pbar.close()
-    sys.stderr.write("Finished processing file: {}\n".format(args.input_fastx))
-    fail_nr = rfq_sup["total"] - rfq_sup["pass"]
-    fail_pc = (fail_nr * 100 / rfq_sup["total"])
-    st["QcFail"] = fail_nr
+    sys.stderr.write("Finished processing {}\n".format(input_desc))
+    # Readers parsing the input rarely waiting for the workers means that input is the bottleneck.
+    # Memory mapped inputs are parsed by the workers, their readers only generate byte ranges:
+    parse_timings = [t for t, parsed in zip(reader_timings, parsed_inputs) if parsed]
+    if len(parse_timings) > 0:
+        elapsed = max(sum(t["end"] - t["start"] for t in parse_timings), 1e-9)
+        sys.stderr.write("Input parsing busy {:.0f}% of {:.1f}s.\n".format(
+            100 * (elapsed - sum(t["wait"] for t in parse_timings)) / elapsed, elapsed))
+    decompressed = [sup["input"] for sup in rfq_sups if sup["input"] is not None]
+    if len(decompressed) > 0:
+        sys.stderr.write(report_inputs(decompressed) + "\n")
+    fail_nr = st["QcFail"]
+    fail_pc = (fail_nr * 100 / (st["PassReads"] + fail_nr))
     sys.stderr.write(
         "Input reads failing mean quality filter (Q < {}): {} ({:.2f}%)\n".format(
             args.Q, fail_nr, fail_pc))
@@ -558,7 +818,7 @@ def main():
     if args.S is not None:
         stdf.to_csv(args.S, sep="\t", index=False)
 
-    for fh in (out_fh, u_fh, l_fh, w_fh, a_fh, d_fh):
+    for fh in (out_fh, u_fh, l_fh, w_fh, a_fh, d_fh, k_fh):
         if fh is None:
             continue
         fh.flush()
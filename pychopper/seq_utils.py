@@ -4,10 +4,12 @@
 from math import log
 import sys
 
+import numpy as np
 from numpy.random import random
 from pysam import FastxFile
 
 from pychopper.common_structures import Seq
+from pychopper import gzip_reader
 
 # Reverse complements of bases, taken from dragonet:
 comp = {
@@ -48,39 +50,115 @@ def reverse_complement(seq):
     return seq.translate(comp_trans)[::-1]
 
 
-def readfq(fastq, sample=None, min_qual=0, rfq_sup={}):  # this is a generator function
+def readfq(fastq, sample=None, min_qual=0, rfq_sup={}, threads=None):  # this is a generator function
     """Read fastx files.
 
     This is a generator function that yields sequtils.Seq objects.
-    Optionally filter by a minimum mean quality (min_qual).
+    Optionally filter by a minimum mean quality (min_qual), None disables the filter.
+    Records without qualities (fasta) are not filtered.
     Optionally subsample the fastx file using sample (0.0 - 1.0)
+    If threads is not None, gzip/BGZF input is decompressed by that many background threads,
+    the DecompressedInput is stored in rfq_sup["input"] if that key is present.
     """
     sup = ("out_fq" in rfq_sup) and (rfq_sup["out_fq"] is not None)
     tsup = "total" in rfq_sup
     if sup:
         fh = open(rfq_sup["out_fq"], "w")
 
-    with FastxFile(fastq) as fqin:
-        for fx in fqin:
-            if sample is None or (random() < sample):
-                if tsup:
-                    rfq_sup["total"] += 1
-                probs = [10 ** (q / -10) for q in fx.get_quality_array()]
-                if (-10 * log(sum(probs) / len(probs), 10)) >= min_qual:
+    inp = None
+    if threads is not None and fastq != "-" and gzip_reader.is_gzip(fastq):
+        # pysam parses the stream decompressed by the background threads:
+        inp = gzip_reader.DecompressedInput(fastq, threads)
+        if "input" in rfq_sup:
+            rfq_sup["input"] = inp
+        fastq = inp.path
+
+    try:
+        with FastxFile(fastq) as fqin:
+            for fx in fqin:
+                if sample is None or (random() < sample):
                     if tsup:
-                        rfq_sup["pass"] += 1
-                    yield Seq(
-                        Id=fx.name,
-                        Name=f"{fx.name} {fx.comment}" if fx.comment else fx.name,
-                        Seq=fx.sequence, Qual=fx.quality, Umi=None)
-                else:
-                    if sup:
-                        fh.write(f"{fx}\n")
+                        rfq_sup["total"] += 1
+                    if min_qual is None or not fx.quality or mean_qual(fx.quality) >= min_qual:
+                        if tsup:
+                            rfq_sup["pass"] += 1
+                        yield Seq(
+                            Id=fx.name,
+                            Name=f"{fx.name} {fx.comment}" if fx.comment else fx.name,
+                            Seq=fx.sequence, Qual=fx.quality, Umi=None)
+                    else:
+                        if sup:
+                            fh.write(f"{fx}\n")
+    finally:
+        if inp is not None:
+            inp.close()
     if sup:
         fh.flush()
         fh.close()
 
 
+def is_fastq(fastq):
+    """Check whether a file is an uncompressed, non-empty fastq file of four-line records, which can
+    be parsed in byte ranges. Only the first record is probed: a multi-line record has its third line
+    not starting with + or a quality line shorter than the sequence.
+    """
+    with open(fastq, "rb") as fh:
+        header, seq, plus, qual = (fh.readline() for _ in range(4))
+    return header[:1] == b"@" and plus[:1] == b"+" and len(seq.rstrip(b"\n")) == len(qual.rstrip(b"\n"))
+
+
+def _next_record(buf, pos):
+    """Find the start of the first fastq record at or after byte pos of buf. A record starts
+    with a line starting with @ followed by a line and a line starting with +, which a quality
+    line starting with @ cannot be followed by.
+    """
+    if pos > 0:
+        pos = buf.find(b"\n", pos - 1) + 1
+        if pos == 0:
+            return len(buf)
+    while pos < len(buf):
+        if buf[pos:pos + 1] == b"@":
+            seq_start = buf.find(b"\n", pos) + 1
+            plus_start = buf.find(b"\n", seq_start) + 1 if seq_start > 0 else 0
+            if plus_start > 0 and buf[plus_start:plus_start + 1] == b"+":
+                return pos
+        pos = buf.find(b"\n", pos) + 1
+        if pos == 0:
+            break
+    return len(buf)
+
+
+def readfq_range(buf, start, end):
+    """Parse the fastq records starting in the byte range [start, end) of buf (a bytes-like
+    object, usually a memory mapped file). Ranges covering a file yield each record once.
+    Only four-line fastq records are supported. Returns a list of Seq objects.
+    """
+    res = []
+    pos = _next_record(buf, start)
+    size = len(buf)
+    while pos < min(end, size):
+        if buf[pos:pos + 1] == b"\n":
+            pos += 1
+            continue
+        seq_start = buf.find(b"\n", pos) + 1
+        plus_start = buf.find(b"\n", seq_start) + 1 if seq_start > 0 else 0
+        qual_start = buf.find(b"\n", plus_start) + 1 if plus_start > 0 else 0
+        if qual_start == 0 or buf[pos:pos + 1] != b"@" or buf[plus_start:plus_start + 1] != b"+":
+            raise Exception("Invalid fastq record at byte {}: only four-line fastq records can be parsed in byte ranges!".format(pos))
+        qual_end = buf.find(b"\n", qual_start)
+        if qual_end < 0:
+            qual_end = size
+        header = buf[pos + 1:seq_start - 1].decode().split(None, 1)
+        seq = buf[seq_start:plus_start - 1].decode()
+        qual = buf[qual_start:qual_end].decode()
+        if len(qual) != len(seq):
+            raise Exception("Sequence and quality lengths differ in fastq record at byte {}!".format(pos))
+        # Like pysam, empty quality strings are missing:
+        res.append(Seq(Id=header[0], Name=" ".join(header), Seq=seq, Qual=qual or None, Umi=None))
+        pos = qual_end + 1
+    return res
+
+
 def writefq(r, fh):
     "Write read to fastq file"
     q = r.Qual
@@ -134,7 +212,32 @@ def errs_tab(n):
     return [10**(q / -10) for q in range(n + 1)]
 
 
-def mean_qual(quals, qround=False, tab=errs_tab(128)):
+# Error probabilities of the ASCII quality characters (Phred+33):
+_ERR_TAB = np.array([1.0] * 33 + errs_tab(255 - 33))
+
+
+def mean_errors(quals_list):
+    """Calculate the mean error probabilities of many quality strings at once.
+    Quality characters are converted using a lookup table, empty or missing
+    qualities have a mean error probability of one.
+    """
+    quals_list = [q or "" for q in quals_list]
+    lengths = np.array([len(q) for q in quals_list], dtype=np.int64)
+    errs = _ERR_TAB[np.frombuffer("".join(quals_list).encode(), dtype=np.uint8)]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    nonempty = lengths > 0
+    res = np.ones(len(quals_list))
+    if nonempty.any():
+        res[nonempty] = np.add.reduceat(errs, starts[nonempty]) / lengths[nonempty]
+    return res
+
+
+def mean_quals(quals_list):
+    "Calculate the average basecall qualities of many reads at once, see mean_errors"
+    return -10 * np.log10(mean_errors(quals_list))
+
+
+def mean_qual(quals, qround=False):
     """Calculate average basecall quality of a read.
     Receive the ascii quality scores of a read and return the average quality for that read
     First convert Phred scores to probabilities,
@@ -142,7 +245,7 @@ def mean_qual(quals, qround=False, tab=errs_tab(128)):
     convert average back to Phred scale
     """
     if quals:
-        mq = -10 * log(sum([tab[ord(q) - 33] for q in quals]) / len(quals), 10)
+        mq = -10 * log(mean_errors([quals])[0], 10)
         if qround:
             return round(mq)
         else:
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import unittest
+from pychopper.common_structures import Hit
+from pychopper import chopper, utils
+from pychopper.alignment_hits import HitBatch, process_hits, process_hits_batch
+
+
+class TestChopper(unittest.TestCase):
+
+    def testAnalyseHitsBatch(self):
+        """ Batch segmentation gives the same segments as analyse_hits. """
+        config = utils.parse_config_string("+:SSP,-VNP|-:VNP,-SSP")
+        pos = [(0, "SSP"), (100, "-VNP"), (130, "SSP"), (400, "-VNP"), (420, "VNP"), (600, "-SSP")]
+        batch = [
+            tuple(Hit("r", p, p + 25, q, 0, 25, 0.1) for p, q in pos[:n]) for n in (0, 1, 2, 3, 4, 6)
+        ]
+        batch.append(tuple(Hit("r", p, p + 25, q, 0, 25, 0.1) for p, q in pos[::-1]))
+        res = chopper.analyse_hits_batch(HitBatch.from_hits(batch), config)
+        for (segments, hits, tlen), old_hits in zip(res, batch):
+            exp_segments, exp_hits, exp_tlen = chopper.analyse_hits(old_hits, config)
+            self.assertEqual((segments, tlen), (exp_segments, exp_tlen))
+            self.assertEqual(tuple(hits), tuple(h._replace(Ref=None) for h in exp_hits))
+        self.assertEqual(len(res[5][0]), 3)
+
+    def testProcessHitsBatch(self):
+        """ Columnar hit filtering keeps the same hits as process_hits. """
+        hits = [Hit("r", 50, 75, "A", 0, 25, 0.5), Hit("r", 0, 25, "A", 0, 25, 0.1),
+                Hit("r", 10, 30, "B", 0, 20, 0.01), Hit("r", 60, 80, "B", 0, 20, 2.0)]
+        batch = HitBatch.from_hits([hits, [], hits[:1]])
+        res = process_hits_batch(batch, 1.0)
+        self.assertEqual(list(res.read_hits(0)), [h._replace(Ref=None) for h in process_hits(hits, 1.0)])
+        self.assertEqual(len(res.read_hits(1)), 0)
+        self.assertEqual(len(res.read_hits(2)), 1)
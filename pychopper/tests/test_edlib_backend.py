@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import unittest
+from pychopper import edlib_backend
+from pychopper.common_structures import Hit, Seq
+from pychopper.parasail_backend import refine_locations
+from pychopper.primer_index import PrimerIndex
+
+
+class TestEdlibBackend(unittest.TestCase):
+
+    def testSeedWindows(self):
+        """ Only read windows with enough seed matches of a primer are aligned. """
+        primers = {"SSP": "TTTCTGTTGGTGCTGATATTGCTGGG", "-SSP": "CCCAGCAATATCAGCACCAACAGAAA"}
+        read = "A" * 100 + primers["SSP"] + "A" * 200 + "GGG" + "N" * 20
+        index = PrimerIndex(primers, 7)
+        seeds = index.read_seeds(read)
+        self.assertEqual(index.windows(seeds, "SSP", 5), [(69, 157)])
+        self.assertEqual(index.windows(seeds, "-SSP", 5), [])
+
+    def testMergeLocations(self):
+        """ Overlapping edlib locations are refined once over their union, giving the hits of each location. """
+        locations = [(30, 55), (10, 34), (12, 36), (35, 60), (100, 125)]
+        self.assertEqual(edlib_backend.merge_locations(locations), [(10, 61), (100, 126)])
+        primers = {"SSP": "TTTCTGTTGGTGCTGATATTGCTGGG"}
+        edlib_backend.init_worker(primers, 0.4)
+        read = Seq("r", "r", "ACGT" * 10 + "TTTCTGTTGGTGCTGATATTGCTGGA" + "ACGT" * 10 + "TTTCTGTTGGTGCTGATATTGCTGG", None, None)
+        ed, locations = edlib_backend._align_primer(primers["SSP"], read.Seq, 10)
+        self.assertGreater(len(locations), len(edlib_backend.merge_locations(locations)))
+        hits = [Hit("r", start, end + 1, "SSP", 0, 26, ed / 26) for start, end in locations]
+        self.assertEqual(edlib_backend._refine_primer_locations(read, "SSP", primers["SSP"], ed, locations),
+                         refine_locations(read, primers, hits))
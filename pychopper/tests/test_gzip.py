@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import unittest
+import gzip
+import os
+import tempfile
+
+from pychopper import seq_utils as seu
+from pychopper import gzip_reader, gzip_writer
+
+
+class TestGzip(unittest.TestCase):
+
+    def testDecompressedInput(self):
+        """ BGZF and multi-member gzip input is decompressed and parsed unchanged. """
+        data = b"".join(b"@r%d\n%s\n+\n%s\n" % (i, b"ACGT" * i, b"I" * 4 * i) for i in range(1, 5000))
+        with tempfile.TemporaryDirectory() as tmp:
+            bgz, gz = os.path.join(tmp, "r.fq.bgz"), os.path.join(tmp, "r.fq.gz")
+            fh = gzip_writer.open_output(bgz)
+            fh.write(data)
+            fh.close()
+            with open(gz, "wb") as fh:
+                fh.write(gzip.compress(data[:1000]) + gzip.compress(data[1000:]))
+            self.assertTrue(gzip_reader.is_bgzf(bgz))
+            self.assertFalse(gzip_reader.is_bgzf(gz))
+            for path in (bgz, gz):
+                self.assertEqual(b"".join(gzip_reader.decompressed_chunks(path, 2)), data)
+                reads = list(seu.readfq(path, threads=2))
+                self.assertEqual(len(reads), 4999)
+                self.assertEqual(reads[-1].Seq, "ACGT" * 4999)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import unittest
+import shutil
+from os import path
+from pychopper.common_structures import Hit, Seq
+from pychopper import hmmer_backend, seq_utils
+import pychopper.phmm_data as phmm_data
+
+
+class TestHmmerBackend(unittest.TestCase):
+
+    def testGroupHits(self):
+        """ Hits of a read are kept when its rows are not adjacent. """
+        lines = [
+            "# target name accession query name\n",
+            "SSP  -  0  -  1  26  10  35  9  36  26  +  1e-06  22.1  6.2  -\n",
+            "VNP  -  1  -  1  30  5  34  4  35  30  +  2e-05  18.0  1.0  -\n",
+            "-VNP  -  0  -  1  30  500  529  499  530  30  +  3e-04  15.0  1.0  -\n",
+        ]
+        reads = [Seq("r1", "r1", "", None, None), Seq("r2", "r2", "", None, None), Seq("r3", "r3", "", None, None)]
+        res = list(hmmer_backend._group_hits(hmmer_backend._parse_hmmscan_tab(lines), reads))
+        self.assertEqual([h.Query for h in res[0]], ["SSP", "-VNP"])
+        self.assertEqual(res[1], [Hit("r2", 5, 35, "VNP", 1, 31, 2e-05)])
+        self.assertEqual(res[2], [])
+
+    @unittest.skipIf(shutil.which("nhmmscan") is None, "nhmmscan is not installed")
+    def testNearCutoff(self):
+        """ Rounded E-values are near a cutoff when the exact E-values could be on either side of it. """
+        evalues = [1e-05, 1.2e-05, 0.99, 1.0, 0.0, 5.0, 4.8]
+        self.assertEqual(hmmer_backend.near_cutoff(evalues, 1e-05).tolist(), [True, False, False, False, False, False, False])
+        self.assertEqual(hmmer_backend.near_cutoff(evalues, 1.000008).tolist(), [False, False, False, True, False, False, False])
+        self.assertEqual(hmmer_backend.near_cutoff(evalues, 5.0).tolist(), [False, False, False, False, False, True, False])
+
+    def testNhmmscanProcess(self):
+        """ Batches searched by a long-lived nhmmscan process give the hits of separate searches. """
+        phmm = path.join(path.dirname(phmm_data.__file__), "PCS110_primers.hmm")
+        reads = list(seq_utils.readfq(path.join(path.dirname(__file__), "data", "PCS111_umi_test_reads.fastq.gz")))
+        reads.append(Seq("polyA", "polyA", "A" * 200, None, None))
+        single = []
+        for read in reads:
+            nhmmscan = hmmer_backend.NhmmscanProcess(phmm, 1.0)
+            single.extend(nhmmscan.search([read]))
+            nhmmscan.close()
+        self.assertTrue(any(len(hits) > 0 for hits in single))
+        nhmmscan = hmmer_backend.NhmmscanProcess(phmm, 1.0)
+        # Several batches, including an empty one and a batch of reads without hits:
+        self.assertEqual(nhmmscan.search(reads[:3]), single[:3])
+        self.assertEqual(nhmmscan.search([]), [])
+        self.assertEqual(nhmmscan.search(reads[-1:]), [[]])
+        self.assertEqual(nhmmscan.search(reads[3:]), single[3:])
+        self.assertEqual(nhmmscan.search(reads), single)
+        # A failed process raises instead of waiting for its output:
+        nhmmscan.proc.kill()
+        nhmmscan.proc.wait()
+        with self.assertRaises(Exception):
+            nhmmscan.search(reads)
+        nhmmscan.close()
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+import unittest
+import pickle
+
+from pychopper.common_structures import Seq
+from pychopper.read_batch import PackedReads
+
+
+class TestReadBatch(unittest.TestCase):
+
+    def testPackedReads(self):
+        """ Reads packed in shared memory are unpacked unchanged after pickling the handle. """
+        reads = [Seq("r1", "r1 runid=x", "ACGT", "!!!!", None), Seq("r2", "r2", "GG", None, None),
+                 Seq("r3", "r3", "", "", None)]
+        packed = PackedReads.pack(reads)
+        attached = pickle.loads(pickle.dumps(packed))
+        self.assertEqual(attached.unpack(), reads)
+        attached.close()
+        self.assertEqual(len(packed), 3)
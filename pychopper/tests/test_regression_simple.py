@@ -1,7 +1,13 @@
 import unittest
 import os
+import gzip
 from os import path
+import random
+import shutil
 import subprocess
+import tempfile
+
+from pychopper.gzip_reader import is_bgzf
 
 
 class TestIntegration(unittest.TestCase):
@@ -17,8 +23,42 @@ class TestIntegration(unittest.TestCase):
         expected_output = path.join(test_base, 'expected_output.fas')
 
         subprocess.call("{} {} {} {} {}".format('pychopper', "-Y 0 -B 3 -q 0.5 -m edlib -b", barcodes, input_fasta, output_fasta), shell=True)
-        retval = subprocess.call(['cmp', output_fasta, expected_output])
-        self.assertEqual(retval, 0)
+        # Outputs ending in .gz are gzip compressed:
+        self.assertFalse(is_bgzf(output_fasta))
+        with gzip.open(output_fasta, "rb") as out_fh, open(expected_output, "rb") as exp_fh:
+            self.assertEqual(out_fh.read(), exp_fh.read())
+        os.remove(output_fasta)
+
+    def testIntegration_bgzf(self):
+        """ Integration test writing BGZF output with several compression threads. """
+        base = path.dirname(__file__)
+        test_base = path.join(base, 'data')
+
+        barcodes = path.join(test_base, 'barcodes.fas')
+        input_fasta = path.join(test_base, 'ref.fq.gz')
+        output_fasta = path.join(test_base, 'test_output.fq.bgz')
+        expected_output = path.join(test_base, 'expected_output.fas')
+
+        subprocess.call("{} {} {} {} {}".format('pychopper', "-Y 0 -B 3 -q 0.5 -m edlib --compress-threads 2 -b", barcodes, input_fasta, output_fasta), shell=True)
+        # Outputs ending in .bgz are BGZF compressed:
+        self.assertTrue(is_bgzf(output_fasta))
+        with gzip.open(output_fasta, "rb") as out_fh, open(expected_output, "rb") as exp_fh:
+            self.assertEqual(out_fh.read(), exp_fh.read())
+        os.remove(output_fasta)
+
+    def testIntegration_end_window(self):
+        """ Integration test searching the read ends, with cutoff autotuning. """
+        base = path.dirname(__file__)
+        test_base = path.join(base, 'data')
+
+        barcodes = path.join(test_base, 'barcodes.fas')
+        input_fasta = path.join(test_base, 'ref.fq.gz')
+        output_fasta = path.join(test_base, 'test_output_end_window.fq')
+        expected_output = path.join(test_base, 'expected_output.fas')
+
+        subprocess.call("{} {} {} {} {}".format('pychopper', "-B 3 --end-window 200 -m edlib -b", barcodes, input_fasta, output_fasta), shell=True)
+        with open(output_fasta, "rb") as out_fh, open(expected_output, "rb") as exp_fh:
+            self.assertEqual(out_fh.read(), exp_fh.read())
         os.remove(output_fasta)
 
     def testIntegration_umi(self):
@@ -31,7 +71,137 @@ class TestIntegration(unittest.TestCase):
         expected_output = path.join(test_base, 'PCS111_umi_test_reads_expected.fastq')
 
         subprocess.call("{} {} {} {}".format('pychopper', "-U -m edlib -k PCS111", input_fasta, output_fasta), shell=True)
-        retval = subprocess.call(['cmp', output_fasta, expected_output])
-        self.assertEqual(retval, 0)
+        # Outputs ending in .gz are compressed:
+        with gzip.open(output_fasta, "rb") as out_fh, open(expected_output, "rb") as exp_fh:
+            self.assertEqual(out_fh.read(), exp_fh.read())
+        os.remove(output_fasta)
+
+    def testIntegration_phmm(self):
+        """ Integration test of the pHMM backend. """
+        base = path.dirname(__file__)
+        test_base = path.join(base, 'data')
+
+        input_fasta = path.join(test_base, 'PCS111_umi_test_reads.fastq.gz')
+        output_fasta = path.join(test_base, 'test_output_phmm.fq')
+        expected_output = path.join(test_base, 'PCS111_umi_test_reads_expected_phmm.fastq')
+
+        subprocess.call("{} {} {} {}".format('pychopper', "-U -m phmm -k PCS111", input_fasta, output_fasta), shell=True)
+        with open(output_fasta, "rb") as out_fh, open(expected_output, "rb") as exp_fh:
+            self.assertEqual(out_fh.read(), exp_fh.read())
+        os.remove(output_fasta)
+
+    def testIntegration_unordered(self):
+        """ Integration test writing the batches in completion order. """
+        base = path.dirname(__file__)
+        test_base = path.join(base, 'data')
+
+        input_fasta = path.join(test_base, 'PCS111_umi_test_reads.fastq.gz')
+        output_fasta = path.join(test_base, 'test_output_unordered.fq')
+        expected_output = path.join(test_base, 'PCS111_umi_test_reads_expected.fastq')
+
+        subprocess.call("{} {} {} {}".format('pychopper', "-U -m edlib -k PCS111 -t 2 -B 1 --unordered", input_fasta, output_fasta), shell=True)
+        # Same records, in any order:
+        with open(output_fasta, "r") as out_fh, open(expected_output, "r") as exp_fh:
+            out_lines, exp_lines = out_fh.read().splitlines(), exp_fh.read().splitlines()
+        self.assertEqual(sorted(zip(*[iter(out_lines)] * 4)), sorted(zip(*[iter(exp_lines)] * 4)))
         os.remove(output_fasta)
 
+    def testIntegration_long_window(self):
+        """ Integration test searching every read in windows, on both input paths. """
+        base = path.dirname(__file__)
+        test_base = path.join(base, 'data')
+        barcodes = path.join(test_base, 'barcodes.fas')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Reads longer than two windows, with random sequence in the middle:
+            rng = random.Random(1)
+            input_fastq = path.join(tmp, 'long.fq')
+            with gzip.open(path.join(test_base, 'ref.fq.gz'), "rt") as in_fh, open(input_fastq, "w") as out_fh:
+                for name, seq, _, qual in zip(*[iter(in_fh.read().splitlines())] * 4):
+                    mid = len(seq) // 2
+                    fill = "".join(rng.choice("ACGT") for _ in range(3000))
+                    out_fh.write("{}\n{}\n+\n{}\n".format(name, seq[:mid] + fill + seq[mid:], qual[:mid] + "5" * 3000 + qual[mid:]))
+
+            outputs = []
+            for opts in ["--long-window 0", "--long-window 1001", "--long-window 1001 --no-mmap"]:
+                output_fastq, unclass_fastq = path.join(tmp, 'out.fq'), path.join(tmp, 'unclass.fq')
+                subprocess.call("{} {} {} {} -u {} {} {}".format('pychopper', "-Y 0 -B 3 -q 0.5 -m edlib -b", barcodes, opts, unclass_fastq, input_fastq, output_fastq), shell=True)
+                with open(output_fastq, "r") as out_fh, open(unclass_fastq, "r") as unclass_fh:
+                    outputs.append((out_fh.read(), unclass_fh.read()))
+            self.assertTrue(len(outputs[0][0]) > 0)
+            self.assertEqual(outputs[1], outputs[0])
+            self.assertEqual(outputs[2], outputs[0])
+
+    def testIntegration_inputs(self):
+        """ Integration test of several inputs, which are never overwritten by the output. """
+        base = path.dirname(__file__)
+        test_base = path.join(base, 'data')
+        barcodes = path.join(test_base, 'barcodes.fas')
+        expected_output = path.join(test_base, 'expected_output.fas')
+        opts = "-Y 0 -B 3 -q 0.5 -m edlib -b {}".format(barcodes)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            inputs = [path.join(tmp, name) for name in ('a.fq.gz', 'b.fq.gz')]
+            for input_fasta in inputs:
+                shutil.copy(path.join(test_base, 'ref.fq.gz'), input_fasta)
+            output_fasta = path.join(tmp, 'out.fq')
+
+            # Several inputs need -o and inputs are never written, also when found in an input directory:
+            subprocess.call("{} {} {} {} {}".format('pychopper', opts, *inputs, output_fasta), shell=True)
+            self.assertFalse(path.exists(output_fasta))
+            subprocess.call("{} {} -o {} {} {}".format('pychopper', opts, inputs[1], *inputs), shell=True)
+            subprocess.call("{} {} {} {}".format('pychopper', opts, tmp, inputs[1]), shell=True)
+            for input_fasta in inputs:
+                with open(input_fasta, "rb") as in_fh, open(path.join(test_base, 'ref.fq.gz'), "rb") as ref_fh:
+                    self.assertEqual(in_fh.read(), ref_fh.read())
+
+            subprocess.call("{} {} -o {} {} {}".format('pychopper', opts, output_fasta, *inputs), shell=True)
+            with open(output_fasta, "rb") as out_fh, open(expected_output, "rb") as exp_fh:
+                self.assertEqual(out_fh.read(), exp_fh.read() * 2)
+
+            # The output given as the second positional argument is overwritten:
+            subprocess.call("{} {} {} {}".format('pychopper', opts, inputs[0], output_fasta), shell=True)
+            with open(output_fasta, "rb") as out_fh, open(expected_output, "rb") as exp_fh:
+                self.assertEqual(out_fh.read(), exp_fh.read())
+
+    def testIntegration_fasta(self):
+        """ Integration test of fasta input, which is not filtered by mean quality. """
+        base = path.dirname(__file__)
+        test_base = path.join(base, 'data')
+        barcodes = path.join(test_base, 'barcodes.fas')
+        expected_output = path.join(test_base, 'expected_output.fas')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            input_fasta = path.join(tmp, 'ref.fa')
+            with gzip.open(path.join(test_base, 'ref.fq.gz'), "rt") as in_fh, open(input_fasta, "w") as out_fh:
+                for name, seq, _, _ in zip(*[iter(in_fh.read().splitlines())] * 4):
+                    out_fh.write(">{}\n{}\n".format(name[1:], seq))
+            output_fasta = path.join(tmp, 'out.fq')
+
+            subprocess.call("{} {} {} {} {}".format('pychopper', "-B 3 -q 0.5 -m edlib -b", barcodes, input_fasta, output_fasta), shell=True)
+            # Same reads, written with the lowest qualities:
+            with open(output_fasta, "r") as out_fh, open(expected_output, "r") as exp_fh:
+                out_lines, exp_lines = out_fh.read().splitlines(), exp_fh.read().splitlines()
+            self.assertTrue(len(exp_lines) > 0)
+            self.assertEqual([(name, seq) for name, seq, _, _ in zip(*[iter(out_lines)] * 4)],
+                             [(name, seq) for name, seq, _, _ in zip(*[iter(exp_lines)] * 4)])
+
+    def testIntegration_multiline(self):
+        """ Integration test of multi-line fastq input, which is not parsed in byte ranges. """
+        base = path.dirname(__file__)
+        test_base = path.join(base, 'data')
+        barcodes = path.join(test_base, 'barcodes.fas')
+        expected_output = path.join(test_base, 'expected_output.fas')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Sequences and qualities wrapped at 60 bases:
+            input_fastq = path.join(tmp, 'ref.fq')
+            with gzip.open(path.join(test_base, 'ref.fq.gz'), "rt") as in_fh, open(input_fastq, "w") as out_fh:
+                for name, seq, _, qual in zip(*[iter(in_fh.read().splitlines())] * 4):
+                    seq, qual = ("\n".join(s[i:i + 60] for i in range(0, len(s), 60)) for s in (seq, qual))
+                    out_fh.write("{}\n{}\n+\n{}\n".format(name, seq, qual))
+            output_fastq = path.join(tmp, 'out.fq')
+
+            subprocess.call("{} {} {} {} {}".format('pychopper', "-Y 0 -B 3 -q 0.5 -m edlib -b", barcodes, input_fastq, output_fastq), shell=True)
+            with open(output_fastq, "rb") as out_fh, open(expected_output, "rb") as exp_fh:
+                self.assertEqual(out_fh.read(), exp_fh.read())
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import unittest
+import math
+import os
+import tempfile
+
+from pychopper import seq_utils as seu
+
+
+class TestSeqUtils(unittest.TestCase):
+
+    def testMeanQuals(self):
+        """ Lookup table mean qualities match the Phred formula. """
+        quals = ["+5?!", "", "I" * 10, None, "#"]
+        exp = [-10 * math.log10(sum(10 ** ((ord(c) - 33) / -10) for c in q) / len(q)) for q in quals[:1]]
+        res = seu.mean_quals(quals)
+        self.assertAlmostEqual(res[0], exp[0])
+        self.assertAlmostEqual(res[2], 40.0)
+        self.assertEqual((res[1], res[3]), (0.0, 0.0))
+        self.assertAlmostEqual(seu.mean_qual("#"), 2.0)
+        self.assertEqual(seu.mean_qual(""), 0.0)
+
+    def testReadfqRange(self):
+        """ Byte ranges of a fastq file yield each record once, quality lines starting with @ included. """
+        data = b"".join(b"@r%d c=%d\n%s\n+\n%s\n" % (i, i, b"ACGT"[:i % 5], b"@+I!"[:i % 5]) for i in range(50))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "r.fq")
+            with open(path, "wb") as fh:
+                fh.write(data)
+            self.assertTrue(seu.is_fastq(path))
+            exp = list(seu.readfq(path, min_qual=None))
+            # Multi-line records are left to readfq:
+            for multi in (b"@r\nAC\nGT\n+\n!!!!\n", b"@r\nACGT\n+\n!!\n!!\n"):
+                with open(path, "wb") as fh:
+                    fh.write(multi)
+                self.assertFalse(seu.is_fastq(path))
+        for size in (1, 7, 100, len(data)):
+            reads = [r for s in range(0, len(data), size) for r in seu.readfq_range(data, s, min(s + size, len(data)))]
+            self.assertEqual(reads, exp)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import unittest
+from pychopper.common_structures import Seq, Segment
+from pychopper import edlib_backend
+from pychopper.umi import UmiMatcher
+
+
+class TestUmi(unittest.TestCase):
+
+    def testUmiMatcher(self):
+        """ UMIs found in the flanks match the edlib search of the whole read. """
+        umi = "TTTAGCATTCAGATTCCGATTGACCTTT"
+        read = Seq("r1", "r1", "ACGT" * 5 + umi[:10] + "G" + umi[10:] + "A" * 300 + "CCCTTTGGG" * 3, None, None)
+        matcher = UmiMatcher()
+        res = matcher.find_umis([(read, Segment(50, 60, 300, 310, "+", 240)), (read, Segment(0, 10, 30, 40, "+", 20))])
+        self.assertEqual(res[0], (umi[:10] + "G" + umi[10:], 1))
+        self.assertEqual(res[1], edlib_backend.find_umi_single([read.Seq, 3]))
+
+    def testUmiSpacer(self):
+        """ Like the search of the flanks joined by an N spacer, UMIs cut by a flank edge are rejected. """
+        umi = "TTTACGATTCAGCTTGACATTCGAGTTT"
+        read = Seq("r1", "r1", ("GACA" * 100)[:258] + umi + ("GACA" * 100)[:114], None, None)
+        segment = Segment(10, 40, 300, 330, "+", 260)
+        flanks = read.Seq[0:80] + "N" * 31 + read.Seq[260:370]
+        self.assertEqual(edlib_backend.find_umi_single([flanks, 3]), (None, None))
+        self.assertEqual(UmiMatcher().find_umi(read, segment), (None, None))
+        # The whole UMI inside the flank is found:
+        self.assertEqual(UmiMatcher().find_umi(read, segment._replace(End=298)), (umi, 0))
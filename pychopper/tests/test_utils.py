@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import unittest
+import concurrent.futures
+import os
+import tempfile
+import numpy as np
+
+from pychopper.common_structures import Hit, Seq
+from pychopper import utils
+
+
+class TestUtils(unittest.TestCase):
+
+    def testOrderedMap(self):
+        """ Pipelined mapping keeps the input order and raises errors of the input. """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
+            res = utils.ordered_map(pool, lambda x: x * x, utils.background_iter(range(50), 4), 4)
+            self.assertEqual(list(utils.background_iter(res, 2)), [x * x for x in range(50)])
+            res = utils.unordered_map(pool, lambda x: x * x, range(50), 4)
+            self.assertEqual(sorted(res), [x * x for x in range(50)])
+
+        def failing():
+            yield 1
+            raise ValueError("bad input")
+        with self.assertRaises(ValueError):
+            list(utils.background_iter(failing(), 1))
+
+    def testBaseBatches(self):
+        """ Batches are closed at the base limit and long reads are processed on their own. """
+        reads = [Seq(str(i), str(i), "A" * n, None, None) for i, n in enumerate([10, 20, 50, 5, 5, 5, 100, 1])]
+        batches = list(utils.batch(reads, 3, 30))
+        self.assertEqual([[r.Id for r in b] for b in batches], [["0", "1"], ["2"], ["3", "4", "5"], ["6"], ["7"]])
+        self.assertEqual([len(b) for b in utils.batch(reads, 3)], [3, 3, 2])
+
+    def testReadWindows(self):
+        """ Windows of long reads cover the read and their hits are merged without duplicates. """
+        read = Seq("r", "r", "ACGT" * 1000, None, None)
+        windows = utils.read_windows(read, 1500, 500)
+        self.assertEqual([offset for offset, _ in windows], [0, 1000, 2000, 3000])
+        self.assertEqual(windows[-1][1].Seq, read.Seq[3000:])
+        # Windows have to be longer than their overlap:
+        with self.assertRaises(Exception):
+            utils.read_windows(read, 500, 500)
+        hits = [Hit("r", 1100, 1125, "A", 0, 25, 0.2), Hit("r", 1101, 1125, "A", 1, 25, 0.1),
+                Hit("r", 1100, 1125, "B", 0, 25, 0.3), Hit("r", 0, 25, "A", 0, 25, 0.5)]
+        self.assertEqual(utils.dedup_hits(hits), [hits[3], hits[1], hits[2]])
+
+    def testSearchReadEndsAll(self):
+        """ Hits kept for tuning give the end window search at each cutoff, with the whole read fallback. """
+        def search(reads):
+            # Hits at the digits of the reads, scored by the digit:
+            return [[Hit(r.Id, i, i + 1, "P", 0, 1, int(c)) for i, c in enumerate(r.Seq) if c.isdigit()] for r in reads]
+
+        seqs = ["1AAAAAAAAAA3", "1AAAA2AAAAA4", "A2AAAAAAA1AAA12A", "1AA2", "AAAAAA4AAAAAAA", "2A1"]
+        reads = [Seq(str(i), str(i), seq, None, None) for i, seq in enumerate(seqs)]
+        res = utils.search_read_ends_all(search, reads, 3)
+        hits = [h for read_hits, _ in res for h in read_hits]
+        read_ids = np.repeat(np.arange(len(reads)), [len(read_hits) for read_hits, _ in res])
+        kinds = np.array([k for _, read_kinds in res for k in read_kinds])
+        scores = np.array([h.Score for h in hits])
+        for cutoff in range(5):
+            expected = utils.search_read_ends(lambda x: [[h for h in hs if h.Score <= cutoff] for hs in search(x)], reads, 3)
+            mask = utils.select_end_hits(read_ids, kinds, scores <= cutoff, len(reads))
+            selected = [[h for h, i, m in zip(hits, read_ids, mask) if i == j and m] for j in range(len(reads))]
+            self.assertEqual(selected, expected)
+
+    def testMultipleInputs(self):
+        """ Directories and globs are expanded, and inputs read concurrently are chained in order. """
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "pass", "barcode01"))
+            for name in ("pass/b.fastq.gz", "pass/barcode01/a.fq", "pass/notes.txt", "c.fq"):
+                open(os.path.join(tmp, name), "w").close()
+            res = utils.expand_inputs([os.path.join(tmp, "pass"), os.path.join(tmp, "*.fq")])
+            self.assertEqual([os.path.relpath(f, tmp) for f in res], ["pass/b.fastq.gz", "pass/barcode01/a.fq", "c.fq"])
+            with self.assertRaises(Exception):
+                utils.expand_inputs([os.path.join(tmp, "*.bam")])
+        timings = []
+        res = utils.chain_background((range(i * 10, i * 10 + 10) for i in range(7)), 3, 2, timings)
+        self.assertEqual(list(res), list(range(70)))
+        self.assertEqual(len(timings), 7)
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+import edlib
+import numpy as np
+
+from pychopper import seq_utils as seu
+
+# UMI probes: pattern, wildcard, edlib equalities of the wildcard and orientation.
+UMI_PATTERNS = [
+    (
+        "TTTVVVVTTVVVVTTVVVVTTVVVVTTT",
+        "V",
+        [("V", "A"), ("V", "G"), ("V", "C")],
+        True
+    ),
+    (
+        "AAABBBBAABBBBAABBBBAABBBBAAA",
+        "B",
+        [("B", "T"), ("B", "G"), ("B", "C")],
+        False
+    )
+]
+
+
+def _compile_peq(pattern, equalities):
+    """Build the match bit masks of a pattern for all byte values, bit i is set if
+    the byte matches position i of the pattern (the Peq table of Myers' algorithm).
+    """
+    eq = set(equalities) | set((b, a) for a, b in equalities)
+    peq = np.zeros(256, dtype=np.uint64)
+    for c in range(256):
+        mask = 0
+        for i, p in enumerate(pattern):
+            if p == chr(c) or (p, chr(c)) in eq:
+                mask |= 1 << i
+        peq[c] = mask
+    return peq
+
+
+def _myers(eqs, lengths, sizes, anchored):
+    """Run Myers' bit-vector edit distance algorithm on many rows at once.
+
+    eqs holds the match masks of the pattern of each row for each text column (columns x rows),
+    rows are sorted by decreasing text length and sizes are the pattern lengths. The start of the
+    alignment is free in the text (edlib HW mode), or anchored at the first column (edlib SHW mode).
+    Return the best edit distance of each row, with the first and last columns it is reached at.
+    """
+    n = len(lengths)
+    dtype = eqs.dtype
+    one = dtype.type(1)
+    mask = (one << sizes.astype(dtype)) - one
+    last = (sizes - 1).astype(dtype)
+    pv = mask.copy()
+    mv = np.zeros(n, dtype=dtype)
+    score = sizes.astype(np.int32)
+    # Edit distance at each column, columns past the end of the text are never the best:
+    scores = np.full(eqs.shape, np.iinfo(np.int32).max, dtype=np.int32)
+    # Work arrays, the vectors of the active rows are updated in place:
+    xv, xh, ph, mh, tmp = (np.empty(n, dtype=dtype) for _ in range(5))
+    active = n
+    for col in range(eqs.shape[0]):
+        while active > 0 and lengths[active - 1] <= col:
+            active -= 1
+        if active == 0:
+            break
+        a = slice(0, active)
+        eq, pv_a, mv_a, mask_a, t = eqs[col, a], pv[a], mv[a], mask[a], tmp[a]
+        xv_a = np.bitwise_or(eq, mv_a, out=xv[a])
+        xh_a = np.bitwise_and(eq, pv_a, out=xh[a])
+        xh_a += pv_a
+        xh_a ^= pv_a
+        xh_a |= eq
+        np.bitwise_or(xh_a, pv_a, out=t)
+        np.invert(t, out=t)
+        t &= mask_a
+        ph_a = np.bitwise_or(mv_a, t, out=ph[a])
+        mh_a = np.bitwise_and(pv_a, xh_a, out=mh[a])
+        # Score changes by the horizontal deltas of the last pattern position:
+        sc = score[a]
+        np.right_shift(ph_a, last[a], out=t)
+        t &= one
+        sc += t.astype(np.int32, copy=False)
+        np.right_shift(mh_a, last[a], out=t)
+        t &= one
+        sc -= t.astype(np.int32, copy=False)
+        scores[col, a] = sc
+        ph_a <<= one
+        if anchored:
+            ph_a |= one
+        ph_a &= mask_a
+        mh_a <<= one
+        mh_a &= mask_a
+        np.bitwise_or(xv_a, ph_a, out=t)
+        np.invert(t, out=t)
+        t &= mask_a
+        np.bitwise_or(mh_a, t, out=pv_a)
+        np.bitwise_and(ph_a, xv_a, out=mv_a)
+    first_col = np.argmin(scores, axis=0)
+    best = scores[first_col, np.arange(n)]
+    last_col = eqs.shape[0] - 1 - np.argmin(scores[::-1], axis=0)
+    return best, first_col, last_col
+
+
+class _WindowTexts:
+    """Texts of windows of an encoded buffer, window k starts at offset starts[k] of the buffer and
+    only its columns in [bases_from[k], bases_to[k]) are taken from the buffer, the others are N.
+    """
+
+    def __init__(self, buff, starts, bases_from, bases_to):
+        self.buff = buff
+        self.starts = starts
+        self.bases_from = bases_from
+        self.bases_to = bases_to
+
+    def columns(self, windows, cols):
+        "Get the bytes at columns cols of windows, as an array broadcasting the two"
+        text = self.buff[np.clip(self.starts[windows] + cols, 0, len(self.buff) - 1)]
+        return np.where((cols >= self.bases_from[windows]) & (cols < self.bases_to[windows]), text, np.uint8(ord("N")))
+
+    def string(self, k, length):
+        "Get the text of window k as a string of the given length"
+        return self.columns(np.array([k]), np.arange(length)).astype(np.uint8).tobytes().decode()
+
+
+class UmiMatcher:
+    """Find UMIs next to the primers of segments.
+
+    The UMI probes are compiled once into bit masks, and the two flanks of the segments are scanned
+    as windows of the encoded reads, without building new sequences. The probes are aligned to the
+    windows of many segments at once by a vectorized bit-parallel (Myers) algorithm, giving the same
+    hits as edlib in HW mode. Like find_umi_single on the flanks joined by an N spacer, the flanks
+    are extended by spacer bases on their inner side, and hits running into the spacer are rejected.
+    """
+
+    def __init__(self, patterns=UMI_PATTERNS, max_ed=3, padding=40, max_window=256):
+        for pattern, _, _, _ in patterns:
+            if len(pattern) > 64:
+                raise Exception("UMI patterns longer than 64 bases are not supported!")
+        self.patterns = patterns
+        self.max_ed = max_ed
+        self.padding = padding
+        # Windows longer than this are aligned by edlib:
+        self.max_window = max_window
+        self._sizes = np.array([len(p[0]) for p in patterns])
+        # Match masks fit 32-bit words for the default probes:
+        dtype = np.uint32 if max(self._sizes) <= 32 else np.uint64
+        self._peqs = np.stack([_compile_peq(pattern, equalities) for pattern, _, equalities, _ in patterns]).astype(dtype)
+        self._rev_peqs = np.stack([_compile_peq(pattern[::-1], equalities) for pattern, _, equalities, _ in patterns]).astype(dtype)
+
+    def windows(self, read, segment):
+        "Get the flank windows of a segment searched for UMIs as (start, end) tuples"
+        p1_from = max(0, segment.Left - self.padding)
+        p1_to = min(len(read.Seq), segment.Start + self.padding)
+        p2_from = max(0, segment.End - self.padding)
+        p2_to = min(len(read.Seq), segment.Right + self.padding)
+        # If the read is small and the flanks overlap, search the whole read:
+        if p1_to >= p2_from:
+            return [(0, len(read.Seq))]
+        return [(p1_from, p1_to), (p2_from, p2_to)]
+
+    def _windows(self, read_segments, read_lens):
+        """Get the flank windows of many segments, given the lengths of their reads.
+        Return an array of (start, end) rows, the index of the segment owning each window and the
+        side of each window: 1 for the first flank, 2 for the second flank and 0 for whole reads.
+        """
+        coords = np.array([(s.Left, s.Start, s.End, s.Right) for _, s in read_segments], dtype=np.int64)
+        p1_from = np.maximum(0, coords[:, 0] - self.padding)
+        p1_to = np.minimum(read_lens, coords[:, 1] + self.padding)
+        p2_from = np.maximum(0, coords[:, 2] - self.padding)
+        p2_to = np.minimum(read_lens, coords[:, 3] + self.padding)
+        whole = p1_to >= p2_from
+        p1_from[whole], p1_to[whole] = 0, read_lens[whole]
+        wins = np.stack([np.stack([p1_from, p1_to], axis=1), np.stack([p2_from, p2_to], axis=1)], axis=1)
+        owners = np.repeat(np.arange(len(read_segments)), 2)
+        sides = np.tile(np.array([1, 2]), len(read_segments))
+        sides[0::2][whole] = 0
+        keep = np.repeat(np.array([True]), 2 * len(read_segments))
+        keep[1::2] = ~whole
+        return wins.reshape(-1, 2)[keep], owners[keep], sides[keep]
+
+    def find_umi(self, read, segment):
+        "Find the UMI of a segment, return the UMI and its edit distance or (None, None)"
+        return self.find_umis([(read, segment)])[0]
+
+    def find_umis(self, read_segments):
+        "Find the UMIs of a list of (read, segment) pairs, return a list of (UMI, edit distance) pairs"
+        if len(read_segments) == 0:
+            return []
+        # Encode the reads once, windows are given by their offsets in the buffer:
+        reads, read_index = [], {}
+        for read, _ in read_segments:
+            if id(read) not in read_index:
+                read_index[id(read)] = len(reads)
+                reads.append(read)
+        buff = np.frombuffer("".join(read.Seq for read in reads).encode(), dtype=np.uint8)
+        read_lens = np.array([len(read.Seq) for read in reads], dtype=np.int64)
+        read_offsets = np.cumsum(read_lens) - read_lens
+        owner_reads = np.array([read_index[id(read)] for read, _ in read_segments], dtype=np.int64)
+        wins, owners, sides = self._windows(read_segments, read_lens[owner_reads])
+        # Windows are given by the buffer offset of their first column and the columns holding read
+        # bases, the others are spacer bases. Hits within max_ed reach at most max_ed spacer bases:
+        bases_from = np.where(sides == 2, self.max_ed, 0)
+        bases_to = bases_from + wins[:, 1] - wins[:, 0]
+        lengths = bases_to + np.where(sides == 1, self.max_ed, 0)
+        starts = read_offsets[owner_reads[owners]] + wins[:, 0] - bases_from
+        texts = _WindowTexts(buff, starts, bases_from, bases_to)
+        # Edit distances and first hit ends of all probes in all windows:
+        eds, ends = self._search(texts, lengths)
+
+        # Best edit distance of each probe across the windows of each segment,
+        # ties are resolved in favour of the first window. Then pick the best probe
+        # of each segment, with the same precedence as find_umi_single: an exact
+        # match of a probe does not prevent picking the next one.
+        nr_segments = len(read_segments)
+        best_eds = np.full(nr_segments, -1, dtype=np.int64)
+        best_probes = np.full(nr_segments, -1, dtype=np.int64)
+        best_windows = np.full(nr_segments, -1, dtype=np.int64)
+        for j in range(len(self.patterns)):
+            seg_eds = np.full(nr_segments, self.max_ed + 1, dtype=np.int64)
+            np.minimum.at(seg_eds, owners, eds[j])
+            hits = np.flatnonzero(eds[j] == seg_eds[owners])[::-1]
+            first = np.full(nr_segments, -1, dtype=np.int64)
+            first[owners[hits]] = hits
+            take = (seg_eds <= self.max_ed) & ((best_eds <= 0) | (seg_eds < best_eds))
+            best_eds[take] = seg_eds[take]
+            best_probes[take] = j
+            best_windows[take] = first[take]
+
+        found = np.flatnonzero(best_probes >= 0)
+        probes, windows = best_probes[found], best_windows[found]
+        hit_ends = ends[probes, windows]
+        hit_starts = self._locate_starts(texts, lengths, hit_ends, probes, windows)
+        # Hits running into the spacer would hold N bases:
+        in_read = (hit_starts >= bases_from[windows]) & (hit_ends < bases_to[windows])
+        umi_from = (wins[windows, 0] + hit_starts - bases_from[windows]).tolist()
+        umi_to = (wins[windows, 0] + hit_ends + 1 - bases_from[windows]).tolist()
+
+        res = [(None, None)] * nr_segments
+        forward = [p[3] for p in self.patterns]
+        for i, j, ed, u_from, u_to, ok in zip(found.tolist(), probes.tolist(), best_eds[found].tolist(), umi_from, umi_to,
+                                              in_read.tolist()):
+            if not ok:
+                continue
+            umi = read_segments[i][0].Seq[u_from:u_to]
+            if not forward[j]:
+                umi = seu.reverse_complement(umi)
+            # Do not assign UMIs where the probe has aligned to ambiguous bases:
+            if 'N' in umi:
+                continue
+            res[i] = (umi, ed)
+        return res
+
+    def _search(self, texts, lengths):
+        """Align all probes to all windows, given by their texts and lengths. Return arrays of shape
+        (number of probes, number of windows) holding the best edit distances (max_ed + 1 if larger
+        than max_ed) and the end of the first hit with that edit distance in the window.
+        """
+        nr_probes = len(self.patterns)
+        eds = np.full((nr_probes, len(lengths)), self.max_ed + 1, dtype=np.int64)
+        ends = np.full((nr_probes, len(lengths)), -1, dtype=np.int64)
+        # Long windows are aligned by edlib one by one:
+        for k in np.flatnonzero(lengths > self.max_window):
+            seq = texts.string(k, lengths[k])
+            for j, (pattern, _, equalities, _) in enumerate(self.patterns):
+                result = edlib.align(pattern, seq, task="locations", mode="HW", k=self.max_ed,
+                                     additionalEqualities=equalities)
+                if result["editDistance"] >= 0:
+                    eds[j, k] = result["editDistance"]
+                    ends[j, k] = result["locations"][0][1]
+        short = np.flatnonzero(lengths <= self.max_window)
+        if len(short) == 0:
+            return eds, ends
+        # One row per (window, probe) pair, sorted by decreasing window length:
+        order = short[np.argsort(-lengths[short], kind="stable")]
+        probe = np.tile(np.arange(nr_probes), len(order))
+        row_window = np.repeat(order, nr_probes)
+        cols = np.arange(lengths[order[0]])
+        text = texts.columns(order[None, :], cols[:, None])
+        eqs = np.empty((len(cols), len(order), nr_probes), dtype=self._peqs.dtype)
+        for j in range(nr_probes):
+            eqs[:, :, j] = np.take(self._peqs[j], text)
+        eqs = eqs.reshape(len(cols), -1)
+        best, first_col, _ = _myers(eqs, lengths[row_window],
+                                    self._sizes[probe], anchored=False)
+        hit = best <= self.max_ed
+        eds[probe[hit], row_window[hit]] = best[hit]
+        ends[probe[hit], row_window[hit]] = first_col[hit]
+        return eds, ends
+
+    def _locate_starts(self, texts, lengths, hit_ends, probes, windows):
+        """Find the start of the hits of probes ending at hit_ends in windows.
+        Like edlib, the reversed probe is aligned backwards from the end of the hit and the
+        longest alignment reaching the best edit distance is taken.
+        """
+        res = np.zeros(len(probes), dtype=np.int64)
+        long_hits = lengths[windows] > self.max_window
+        for k in np.flatnonzero(long_hits):
+            j, w = probes[k], windows[k]
+            pattern, _, equalities, _ = self.patterns[j]
+            seq = texts.string(w, lengths[w])
+            result = edlib.align(pattern, seq, task="locations", mode="HW", k=self.max_ed,
+                                 additionalEqualities=equalities)
+            res[k] = result["locations"][0][0]
+        rows = np.flatnonzero(~long_hits)
+        if len(rows) == 0:
+            return res
+        # Hits are at most max_ed longer than the probes:
+        spans = np.minimum(hit_ends[rows] + 1, self._sizes[probes[rows]] + self.max_ed)
+        order = rows[np.argsort(-spans, kind="stable")]
+        spans = np.minimum(hit_ends[order] + 1, self._sizes[probes[order]] + self.max_ed)
+        cols = np.arange(spans[0])
+        text = texts.columns(windows[order][None, :], hit_ends[order] - cols[:, None])
+        eqs = np.take(self._rev_peqs.ravel(), probes[order][None, :] * 256 + text)
+        _, _, last_col = _myers(eqs, spans,
+                                self._sizes[probes[order]], anchored=True)
+        res[order] = hit_ends[order] - last_col
+        return res
@@ -1,9 +1,16 @@
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import subprocess as sp
+import threading
+import queue
+import time
+import concurrent.futures
+from multiprocessing import resource_tracker
 from itertools import islice, chain
 import numpy as np
 import sys
+import os
+import glob
 
 
 def parse_config_string(s):
@@ -21,14 +28,271 @@ def parse_config_string(s):
     return res
 
 
-def batch(iterable, size):
+# Default maximum number of bases in a batch of reads processed by a worker:
+MAX_BATCH_BASES = 1000000
+
+
+def batch(iterable, size, max_bases=None):
+    """Split an iterable of reads into lists of at most size reads.
+    If max_bases is not None, a batch is also closed once it holds max_bases bases,
+    and reads at least that long are put in batches of their own.
+    """
     sourceiter = iter(iterable)
+    if max_bases is None:
+        while True:
+            batchiter = islice(sourceiter, size)
+            try:
+                yield list(chain([next(batchiter)], batchiter))
+            except StopIteration:
+                return
+    res, bases = [], 0
+    for read in sourceiter:
+        read_len = len(read.Seq)
+        if read_len >= max_bases:
+            if len(res) > 0:
+                yield res
+                res, bases = [], 0
+            yield [read]
+            continue
+        res.append(read)
+        bases += read_len
+        if len(res) >= size or bases >= max_bases:
+            yield res
+            res, bases = [], 0
+    if len(res) > 0:
+        yield res
+
+
+def batch_bases(reads):
+    "Total number of bases in a batch of reads"
+    return sum(len(read.Seq) for read in reads)
+
+
+def balanced_map(executor, func, items, weights):
+    """Map func over items using an executor, submitting the items with the largest weights
+    (e.g. number of bases) first, so long tasks do not end up at the tail of the schedule.
+    Results are yielded in the order of the items.
+    """
+    futures = [None] * len(items)
+    for i in sorted(range(len(items)), key=lambda i: weights[i], reverse=True):
+        futures[i] = executor.submit(func, items[i])
+    for future in futures:
+        yield future.result()
+
+
+def _fill_queue(iterable, q, timing):
+    "Put the items of an iterable into a queue, followed by an exception or None once exhausted"
+    error = None
+    try:
+        for item in iterable:
+            t = time.time()
+            q.put((True, item))
+            timing["wait"] += time.time() - t
+    except BaseException as e:
+        error = e
+    timing["end"] = time.time()
+    q.put((False, error))
+
+
+def _start_background(iterable, depth, timing):
+    "Start a thread putting the items of an iterable into a queue of depth items, return the queue"
+    if timing is None:
+        timing = {}
+    timing.update(start=time.time(), end=None, wait=0.0)
+    q = queue.Queue(maxsize=max(depth, 1))
+    threading.Thread(target=_fill_queue, args=(iterable, q, timing), daemon=True).start()
+    return q
+
+
+def _drain_queue(q):
+    "Yield the items of a queue filled by _fill_queue, raising the exceptions of the iterable"
+    while True:
+        ok, item = q.get()
+        if not ok:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+
+def background_iter(iterable, depth, timing=None):
+    """Iterate over an iterable in a background thread, which runs ahead of the consumer by at
+    most depth items. Exceptions raised by the iterable are raised again in the consumer.
+    If timing is a dictionary, the start and end times of the thread and the time it spent
+    waiting for the consumer are recorded in it.
+    """
+    yield from _drain_queue(_start_background(iterable, depth, timing))
+
+
+def chain_background(iterables, readers, depth, timings=None):
+    """Chain iterables, each one iterated in its own background thread running ahead of the
+    consumer by at most depth items. Up to readers iterables are read concurrently, so the next
+    ones are read while the current one is consumed. Items are yielded in order.
+    If timings is a list, the timing dictionary of each thread (see background_iter) is appended to it.
+    """
+    iterables = iter(iterables)
+    pending = deque()
     while True:
-        batchiter = islice(sourceiter, size)
-        try:
-            yield list(chain([next(batchiter)], batchiter))
-        except StopIteration:
+        for iterable in islice(iterables, max(readers, 1) - len(pending)):
+            timing = {}
+            if timings is not None:
+                timings.append(timing)
+            pending.append(_start_background(iterable, depth, timing))
+        if len(pending) == 0:
             return
+        yield from _drain_queue(pending.popleft())
+
+
+def start_workers(executor):
+    """Start the worker processes of a process pool. Workers forked while another thread holds a
+    lock, such as the one of the shared memory resource tracker, deadlock on it, so pools are
+    started before the threads of the pipeline.
+    """
+    # The workers share the resource tracker of this process instead of starting their own:
+    resource_tracker.ensure_running()
+    executor.submit(int).result()
+
+
+def ordered_map(executor, func, iterable, depth):
+    """Map func over an iterable using an executor, keeping at most depth tasks in flight.
+    Results are yielded in the order of the input.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def unordered_map(executor, func, iterable, depth):
+    """Map func over an iterable using an executor, keeping at most depth tasks in flight.
+    Results are yielded as soon as they are completed, regardless of the order of the input.
+    """
+    pending = set()
+    for item in iterable:
+        pending.add(executor.submit(func, item))
+        if len(pending) >= depth:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in concurrent.futures.as_completed(pending):
+        yield future.result()
+
+
+def end_windows(read, size):
+    """Split a read into windows covering its first and last size bases.
+    Return a list of (offset, window read) pairs, reads not longer than two
+    windows are returned whole.
+    """
+    if size is None or len(read.Seq) <= 2 * size:
+        return [(0, read)]
+    tail = len(read.Seq) - size
+    return [(0, read._replace(Seq=read.Seq[:size], Qual=None)),
+            (tail, read._replace(Seq=read.Seq[tail:], Qual=None))]
+
+
+# Overlap of the windows long reads are split into, longer than any primer alignment:
+WINDOW_OVERLAP = 1000
+
+
+def read_windows(read, size, overlap=WINDOW_OVERLAP):
+    """Split a read into windows of size bases, consecutive windows overlapping by overlap bases.
+    Return a list of (offset, window read) pairs.
+    """
+    if size <= overlap:
+        raise Exception("Read windows of {} bases cannot overlap by {} bases!".format(size, overlap))
+    return [(offset, read._replace(Seq=read.Seq[offset:offset + size], Qual=None))
+            for offset in range(0, max(len(read.Seq) - overlap, 1), size - overlap)]
+
+
+def dedup_hits(hits):
+    """Remove duplicates from the hits found in overlapping windows of a read, in read coordinates.
+    Overlapping hits of the same primer are reported once, keeping the best score.
+    """
+    res = []
+    # Index of the last hit of each primer in res:
+    last = {}
+    for hit in sorted(hits, key=lambda x: (x.RefStart, x.RefEnd, x.Query, x.Score)):
+        i = last.get(hit.Query)
+        if i is not None and res[i].RefEnd > hit.RefStart:
+            if hit.Score < res[i].Score:
+                res[i] = hit
+            continue
+        last[hit.Query] = len(res)
+        res.append(hit)
+    return res
+
+
+def shift_hit(hit, offset):
+    "Translate hit coordinates from a window to the read"
+    if offset == 0:
+        return hit
+    return hit._replace(RefStart=hit.RefStart + offset, RefEnd=hit.RefEnd + offset)
+
+
+def search_read_ends(search, reads, size):
+    """Search only the end windows of reads, where search(reads) returns the list of hits for each read.
+    Reads with fewer than two hits in their end windows are searched again as a whole.
+    """
+    if size is None:
+        return search(reads)
+    windows, owners = [], []
+    for i, read in enumerate(reads):
+        for offset, window in end_windows(read, size):
+            windows.append(window)
+            owners.append((i, offset))
+    res = [[] for _ in reads]
+    for (i, offset), hits in zip(owners, search(windows)):
+        res[i].extend(shift_hit(h, offset) for h in hits)
+    redo = [i for i, read in enumerate(reads) if len(res[i]) < 2 and len(read.Seq) > 2 * size]
+    if len(redo) > 0:
+        for i, hits in zip(redo, search([reads[i] for i in redo])):
+            res[i] = hits
+    return res
+
+
+# Kinds of the hits returned by search_read_ends_all: hits of reads searched as a whole only,
+# hits in the end windows of longer reads and hits of the whole read search of longer reads:
+ONLY_HIT, END_HIT, WHOLE_HIT = 0, 1, 2
+
+
+def search_read_ends_all(search, reads, size):
+    """Search reads like search_read_ends, but search the reads longer than two windows both in their
+    end windows and as a whole, so the fallback can be decided later at several cutoffs (see
+    select_end_hits). Returns the list of hits of each read with the list of the kinds of the hits.
+    """
+    if size is None:
+        return [(hits, [ONLY_HIT] * len(hits)) for hits in search(reads)]
+    windows, owners = [], []
+    for i, read in enumerate(reads):
+        if len(read.Seq) > 2 * size:
+            for offset, window in end_windows(read, size):
+                windows.append(window)
+                owners.append((i, offset))
+    end_hits = [None for _ in reads]
+    for i, _ in owners:
+        end_hits[i] = []
+    for (i, offset), hits in zip(owners, search(windows)):
+        end_hits[i].extend(shift_hit(h, offset) for h in hits)
+    res = []
+    for ends, hits in zip(end_hits, search(reads)):
+        if ends is None:
+            res.append((hits, [ONLY_HIT] * len(hits)))
+        else:
+            res.append((ends + hits, [END_HIT] * len(ends) + [WHOLE_HIT] * len(hits)))
+    return res
+
+
+def select_end_hits(read_ids, kinds, passing, nr_reads):
+    """Select the hits search_read_ends would return at a cutoff, given the read index and kind of
+    the hits of search_read_ends_all and a mask of the hits within the cutoff. The whole read hits
+    are used for reads with fewer than two end window hits within the cutoff. Returns a mask.
+    """
+    end_counts = np.bincount(read_ids[passing & (kinds == END_HIT)], minlength=nr_reads)
+    fallback = (end_counts < 2)[read_ids]
+    return passing & ((kinds == ONLY_HIT) | ((kinds == END_HIT) & ~fallback) | ((kinds == WHOLE_HIT) & fallback))
 
 
 def hit2bed(hit, read):
@@ -50,6 +314,52 @@ def hit2bed(hit, read):
     return bed_line
 
 
+def hits2bed(hits, read):
+    """Convert the hits of a read, a ReadHits view of a HitBatch, to BED lines like hit2bed.
+    Returns the lines as a single string.
+    """
+    batch = hits.batch
+    rows = slice(hits.start, hits.end)
+    score = batch.score[rows]
+    max_q = 100
+    with np.errstate(divide="ignore", invalid="ignore"):
+        q = np.where(score == 0, max_q, np.where(score > 1, 0, -10 * np.log10(score)))
+    lines = []
+    for query_id, ref_start, ref_end, hit_q in zip(batch.query_ids[rows].tolist(), batch.ref_start[rows].tolist(),
+                                                   batch.ref_end[rows].tolist(), q.tolist()):
+        name = batch.queries[query_id]
+        strand = "+"
+        if name[0] == "-":
+            name = name[1:]
+            strand = "-"
+        lines.append("%s\t%d\t%d\t%s\t%d\t%s\n" % (read.Name, ref_start, ref_end, name, hit_q, strand))
+    return "".join(lines)
+
+
+# Extensions of the fastx files read from input directories, optionally compressed:
+FASTX_EXTENSIONS = tuple(e + c for c in ("", ".gz", ".bgz") for e in (".fastq", ".fq", ".fasta", ".fa"))
+
+
+def expand_inputs(paths):
+    """Expand a list of input paths: directories are replaced by the fastx files they contain,
+    searched recursively, and paths which do not exist by the files matching them as glob patterns.
+    Returns the list of input files.
+    """
+    res = []
+    for path in paths:
+        if path == "-" or os.path.isfile(path):
+            files = [path]
+        elif os.path.isdir(path):
+            files = sorted(os.path.join(root, f) for root, _, names in os.walk(path)
+                           for f in names if f.endswith(FASTX_EXTENSIONS))
+        else:
+            files = sorted(f for f in glob.glob(path, recursive=True) if os.path.isfile(f))
+        if len(files) == 0:
+            raise Exception("No input files found at {}!".format(path))
+        res.extend(files)
+    return res
+
+
 def count_fastq_records(fname, size=128000000, opener=open):
     fh = opener(fname, "r")
     count = 0